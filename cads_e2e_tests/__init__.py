@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import TYPE_CHECKING, Any
+
 try:
     # NOTE: the `version.py` file must not be present in the git repository
     #   as it is generated by setuptools at install time
@@ -22,17 +24,41 @@ except ImportError:  # pragma: no cover
     # Local copy or not installed with setuptools
     __version__ = "999"
 
-from .models import (
-    Report,
-    Request,
-    dump_report,
-    dump_requests,
-    load_reports,
-    load_requests,
-)
-from .reporter import reports_generator
 from .utils import AbstractCollectionUtils
 
+if TYPE_CHECKING:
+    from .models import (
+        Report,
+        Request,
+        dump_report,
+        dump_requests,
+        load_reports,
+        load_requests,
+    )
+
+_MODELS_ATTRS = {
+    "Report",
+    "Request",
+    "dump_report",
+    "dump_requests",
+    "load_reports",
+    "load_requests",
+}
+
+
+def __getattr__(name: str) -> Any:
+    # The models pull in pydantic, the reporter the datastores client and joblib
+    if name in _MODELS_ATTRS:
+        from . import models
+
+        return getattr(models, name)
+    if name == "reports_generator":
+        from .reporter import reports_generator
+
+        return reports_generator
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 __all__ = [
     "__version__",
     "reports_generator",
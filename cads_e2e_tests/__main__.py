@@ -1,10 +1,8 @@
-import typer
-
 from . import cli
 
 
 def main() -> None:
-    typer.run(cli.make_reports)
+    cli.app()
 
 
 if __name__ == "__main__":
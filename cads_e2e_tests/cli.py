@@ -1,13 +1,48 @@
-from typing import Annotated, Optional
+import collections
+import statistics
+from typing import TYPE_CHECKING, Annotated, Any, Iterator, Optional
 
 import typer
 from typer import Option
+from typer.core import TyperGroup
 
-from . import models, reporter
-from .models import Report
+from . import downloader
 
+if TYPE_CHECKING:
+    # The models pull in pydantic, only import them when a command runs
+    from . import models
+    from .models import Report
 
-def echo_passed_vs_failed(reports: list[Report]) -> None:
+
+def read_requests(path: str) -> Iterator["models.Request"]:
+    from . import models
+
+    with open(path, "r") as fp:
+        if path.endswith(".jsonl"):
+            yield from models.iter_requests(fp)
+        else:
+            yield from models.load_requests(fp)
+
+
+def read_reports(paths: list[str]) -> Iterator["models.Report"]:
+    from . import models
+
+    for path in paths:
+        with open(path, "r") as fp:
+            yield from models.load_reports(fp)
+
+
+def parse_max_in_flight_groups(values: list[str]) -> dict[str, int]:
+    groups = {}
+    for value in values:
+        pattern, sep, cap = value.rpartition("=")
+        if not sep or not cap.isdigit():
+            raise typer.BadParameter(f"{value!r} is not in the PATTERN=N format")
+        groups[pattern] = int(cap)
+    return groups
+
+
+def echo_passed_vs_failed(reports: "list[Report]") -> None:
     n_reports = len(reports)
     typer.secho(
         f"NUMBER OF REPORTS: {n_reports}",
@@ -24,13 +59,52 @@ def echo_passed_vs_failed(reports: list[Report]) -> None:
             typer.secho(f"PASSED: {passed} ({passed_perc:.1f}%)", fg=typer.colors.GREEN)
 
 
+def echo_throttled(reports: "list[Report]") -> None:
+    if throttled := sum(report.throttled for report in reports):
+        typer.secho(f"THROTTLED: {throttled}", fg=typer.colors.YELLOW)
+
+
+def echo_skipped(reports: "list[Report]") -> None:
+    if skipped := sum(report.skipped for report in reports):
+        typer.secho(f"SKIPPED: {skipped}", fg=typer.colors.YELLOW)
+
+
+def echo_cancelled(reports: "list[Report]") -> None:
+    if cancelled := sum(report.cancelled for report in reports):
+        typer.secho(f"CANCELLED: {cancelled}", fg=typer.colors.YELLOW)
+
+
+def echo_download_stats(reports: "list[Report]") -> None:
+    if retries := sum(report.download_retries for report in reports):
+        typer.secho(f"DOWNLOAD RETRIES: {retries}", fg=typer.colors.YELLOW)
+
+    reports_by_collection = collections.defaultdict(list)
+    for report in reports:
+        if report.transfer_time is not None:
+            reports_by_collection[report.request.collection_id].append(report)
+
+    if reports_by_collection:
+        typer.echo("DOWNLOADS (median throughput, time to first byte, transfer time):")
+    for collection_id, collection_reports in sorted(reports_by_collection.items()):
+        throughputs = [r.throughput for r in collection_reports if r.throughput]
+        throughput = statistics.median(throughputs) / 1e6 if throughputs else 0.0
+        ttfb = statistics.median(r.time_to_first_byte or 0 for r in collection_reports)
+        transfer_time = statistics.median(
+            r.transfer_time or 0 for r in collection_reports
+        )
+        typer.echo(
+            f"  {collection_id}: {throughput:.2f} MB/s, {ttfb:.3f} s, "
+            f"{transfer_time:.3f} s ({len(collection_reports)} downloads)"
+        )
+
+
 def make_reports(
     url: Annotated[Optional[str], Option(help="API url")] = None,  # noqa: UP007
     key: Annotated[list[str], Option(help="API key(s)")] = [],
     requests_path: Annotated[
         Optional[str],  # noqa: UP007
         Option(
-            help="Path to the YAML file with requests to test",
+            help="Path to the YAML or JSON Lines file with requests to test",
             show_default="random requests",
         ),
     ] = None,
@@ -45,9 +119,41 @@ def make_reports(
         int,
         Option(help="Number of concurrent requests"),
     ] = 1,
+    backend: Annotated[
+        str,
+        Option(help="Backend used to run concurrent requests (loky or threading)"),
+    ] = "loky",
+    max_in_flight: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Maximum number of concurrent requests per collection",
+            show_default="n-jobs",
+        ),
+    ] = None,
+    max_in_flight_group: Annotated[
+        list[str],
+        Option(
+            help="Maximum number of concurrent requests shared by the collections"
+            " matching a regex pattern (PATTERN=N, can be repeated)"
+        ),
+    ] = [],
+    n_download_jobs: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Number of concurrent downloads",
+            show_default="downloads are performed by the request workers",
+        ),
+    ] = None,
+    download_queue_size: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Maximum number of results waiting to be downloaded",
+            show_default="twice the number of concurrent downloads",
+        ),
+    ] = None,
     verbose: Annotated[
         int,
-        Option(help="The verbosity level of joblib"),
+        Option(help="The verbosity level of the progress messages"),
     ] = 10,
     log_level: Annotated[
         str,
@@ -65,12 +171,56 @@ def make_reports(
         str,
         Option(help="Key used to invalidate the cache"),
     ] = "_no_cache",
+    measure_cache: Annotated[
+        bool,
+        Option(
+            help="Whether to replay each request to compare cold and warm cache latency"
+            " (implies --invalidate-cache)"
+        ),
+    ] = False,
     n_repeats: Annotated[
         int,
         Option(
             help="Number of times to repeat each request (random requests are regenerated)"
         ),
     ] = 1,
+    history_path: Annotated[
+        list[str],
+        Option(
+            help="Path to previous reports used to run the longest expected requests"
+            " first (can be repeated)",
+            show_default="requests run in order",
+        ),
+    ] = [],
+    n_requests: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Number of requests sampled according to the weight of each request"
+            " (replaces --n-repeats, --cyclic and --randomise)",
+            show_default="each request once",
+        ),
+    ] = None,
+    max_relative_width: Annotated[
+        Optional[float],  # noqa: UP007
+        Option(
+            help="Resubmit each request until the confidence interval of its latency"
+            " quantile is narrower than this fraction of the estimate"
+            " (replaces --n-repeats)",
+            show_default="fixed number of repeats",
+        ),
+    ] = None,
+    latency_quantile: Annotated[
+        float,
+        Option(help="Latency quantile estimated with --max-relative-width"),
+    ] = 0.5,
+    min_repeats: Annotated[
+        int,
+        Option(help="Minimum number of repeats with --max-relative-width"),
+    ] = 3,
+    max_repeats: Annotated[
+        int,
+        Option(help="Maximum number of repeats with --max-relative-width"),
+    ] = 30,
     cyclic: Annotated[
         bool,
         Option(
@@ -81,14 +231,104 @@ def make_reports(
         bool,
         Option(help="Whether to randomise the order of the requests"),
     ] = False,
+    seed: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Seed of the random requests and order, to reproduce a workload",
+            show_default="random",
+        ),
+    ] = None,
     max_runtime: Annotated[
         float | None,
         Option(help="Maximum time (in seconds) each request is allowed to run"),
     ] = None,
+    max_queue_time: Annotated[
+        float | None,
+        Option(help="Maximum time (in seconds) each request is allowed to be queued"),
+    ] = None,
+    max_total_time: Annotated[
+        float | None,
+        Option(
+            help="Maximum wall time (in seconds) of each request, from submission to results"
+        ),
+    ] = None,
+    deadline: Annotated[
+        float | None,
+        Option(
+            help="Maximum wall time (in seconds) of the whole run"
+            " (requests not submitted in time are skipped)"
+        ),
+    ] = None,
+    breaker_failures: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help="Number of consecutive failures of a collection that opens its"
+            " circuit breaker (remaining requests are skipped)",
+            show_default="no circuit breaker",
+        ),
+    ] = None,
+    breaker_failure_ratio: Annotated[
+        Optional[float],  # noqa: UP007
+        Option(
+            help="Failure ratio of a collection in the last --breaker-window requests"
+            " that opens its circuit breaker",
+            show_default="no circuit breaker",
+        ),
+    ] = None,
+    breaker_window: Annotated[
+        int,
+        Option(help="Number of requests used to compute the failure ratio"),
+    ] = 10,
+    breaker_probe_interval: Annotated[
+        float,
+        Option(
+            help="Time (in seconds) between probe requests to a collection"
+            " whose circuit breaker is open"
+        ),
+    ] = 60.0,
+    estimate_costs: Annotated[
+        bool,
+        Option(
+            help="Whether to estimate the cost of each request before submitting it"
+        ),
+    ] = False,
+    max_cost: Annotated[
+        float | None,
+        Option(
+            help="Maximum estimated cost of each request (implies --estimate-costs)",
+            show_default="server limit",
+        ),
+    ] = None,
+    max_p95_time: Annotated[
+        Optional[float],  # noqa: UP007
+        Option(
+            help="Maximum 95th percentile of the elapsed time (in seconds)"
+            " of each collection",
+            show_default="p95_time check of each request",
+        ),
+    ] = None,
+    min_median_throughput: Annotated[
+        Optional[float],  # noqa: UP007
+        Option(
+            help="Minimum median download throughput (in MB/s) of each collection",
+            show_default="median_throughput check of each request",
+        ),
+    ] = None,
+    max_failure_rate: Annotated[
+        Optional[float],  # noqa: UP007
+        Option(
+            help="Maximum percentage of failed requests of each collection",
+            show_default="failure_rate check of each request",
+        ),
+    ] = None,
     client_maximum_tries: Annotated[
         int,
         Option(help="Maximum number of retries"),
     ] = 1,
+    cache_licences: Annotated[
+        bool,
+        Option(help="Whether to cache the licences accepted by each key between runs"),
+    ] = False,
     max_replication_lag: Annotated[
         float,
         Option(help="Maximum allowed replication lag (in seconds)"),
@@ -97,6 +337,40 @@ def make_reports(
         bool,
         Option(help="Whether to report the elapsed time of the request"),
     ] = True,
+    download_connections: Annotated[
+        int,
+        Option(
+            help="Number of concurrent ranged requests used to download each result"
+        ),
+    ] = 1,
+    download_part_size: Annotated[
+        int,
+        Option(help="Size (in MiB) of each part of ranged downloads"),
+    ] = downloader.PART_SIZE // 2**20,
+    download_sample_size: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help=("Number of KiB sampled from results without checksum or size checks"),
+            show_default="download whole results",
+        ),
+    ] = None,
+    max_request_rate: Annotated[
+        float | None,
+        Option(
+            help="Maximum number of API calls per second shared by all workers",
+            show_default="unlimited",
+        ),
+    ] = None,
+    pool_maxsize: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(
+            help=(
+                "Maximum number of HTTP connections kept alive per host and key."
+                " With the threading backend all threads share one client per key"
+            ),
+            show_default="10, or one per thread with the threading backend",
+        ),
+    ] = None,
     working_dir: Annotated[
         Optional[str],  # noqa: UP007
         Option(
@@ -105,35 +379,324 @@ def make_reports(
     ] = None,
 ) -> None:
     """CADS E2E Tests."""
-    if requests_path is not None:
-        with open(requests_path, "r") as fp:
-            requests = models.load_requests(fp)
-    else:
-        requests = None
+    requests = None if requests_path is None else read_requests(requests_path)
 
-    reports = []
-    for report in reporter.reports_generator(
+    from . import models, reporter
+
+    reports = reporter.reports_generator(
         url=url,
         keys=key,
         requests=requests,
-        cache_key=cache_key if invalidate_cache else None,
+        cache_key=cache_key if invalidate_cache or measure_cache else None,
+        measure_cache=measure_cache,
         n_jobs=n_jobs,
+        backend=backend,
+        max_in_flight=max_in_flight,
+        max_in_flight_groups=parse_max_in_flight_groups(max_in_flight_group),
+        n_download_jobs=n_download_jobs,
+        download_queue_size=download_queue_size,
         verbose=verbose,
         regex_pattern=regex_pattern,
         download=download,
         n_repeats=n_repeats,
+        n_requests=n_requests,
+        max_relative_width=max_relative_width,
+        latency_quantile=latency_quantile,
+        min_repeats=min_repeats,
+        max_repeats=max_repeats,
+        reports_history=read_reports(history_path) if history_path else None,
         cyclic=cyclic,
         randomise=randomise,
+        seed=seed,
         max_runtime=max_runtime,
+        max_queue_time=max_queue_time,
+        max_total_time=max_total_time,
+        deadline=deadline,
+        breaker_failures=breaker_failures,
+        breaker_failure_ratio=breaker_failure_ratio,
+        breaker_window=breaker_window,
+        breaker_probe_interval=breaker_probe_interval,
+        estimate_costs=estimate_costs,
+        max_cost=max_cost,
         log_level=log_level,
         maximum_tries=client_maximum_tries,
+        cache_licences=cache_licences,
         max_replication_lag=max_replication_lag,
         get_elapsed_time=elapsed_time,
         working_dir=working_dir,
-    ):
+        pool_maxsize=pool_maxsize,
+        max_request_rate=max_request_rate,
+        download_connections=download_connections,
+        download_part_size=download_part_size * 2**20,
+        download_sample_size=None
+        if download_sample_size is None
+        else download_sample_size * 2**10,
+    )
+    aggregate_checks = None
+    if (max_p95_time, min_median_throughput, max_failure_rate) != (None, None, None):
+        aggregate_checks = models.Checks(
+            p95_time=max_p95_time,
+            median_throughput=min_median_throughput,
+            failure_rate=max_failure_rate,
+        )
+    dump_and_echo_reports(reports, reports_path, aggregate_checks)
+
+
+def dump_and_echo_reports(
+    reports_iterator: "Iterator[Report]",
+    path: str,
+    aggregate_checks: "models.Checks | None" = None,
+) -> None:
+    from . import models
+
+    reports = []
+    for report in reports_iterator:
         reports.append(report)
 
-        with open(reports_path, "a") as fp:
+        with open(path, "a") as fp:
             models.dump_report(report, fp)
 
     echo_passed_vs_failed(reports)
+    echo_throttled(reports)
+    echo_cancelled(reports)
+    echo_skipped(reports)
+    echo_download_stats(reports)
+    echo_queue_stats(reports)
+    echo_cache_stats(reports)
+    echo_replay_stats(reports)
+    if not echo_aggregate_checks(reports, aggregate_checks):
+        raise typer.Exit(1)
+
+
+def echo_aggregate_checks(
+    reports: "list[Report]", checks: "models.Checks | None" = None
+) -> bool:
+    from . import models
+
+    tracebacks = models.run_aggregate_checks(reports, checks)
+    if tracebacks:
+        typer.secho("AGGREGATE CHECKS FAILED:", fg=typer.colors.RED)
+    for collection_id, collection_tracebacks in sorted(tracebacks.items()):
+        for traceback in collection_tracebacks:
+            typer.secho(
+                f"  {collection_id}: {traceback.strip().splitlines()[-1]}",
+                fg=typer.colors.RED,
+            )
+    return not tracebacks
+
+
+def echo_queue_stats(reports: "list[Report]") -> None:
+    import numpy as np
+
+    queue_times = collections.defaultdict(list)
+    for report in reports:
+        if report.queue_time is not None:
+            queue_times[report.request.collection_id].append(report.queue_time)
+
+    if queue_times:
+        typer.echo("QUEUE TIME (p50, p90, p99):")
+    for collection_id, values in sorted(queue_times.items()):
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        typer.echo(
+            f"  {collection_id}: {p50:.1f} s, {p90:.1f} s, {p99:.1f} s "
+            f"({len(values)} jobs)"
+        )
+
+
+def echo_cache_stats(reports: "list[Report]") -> None:
+    latencies: dict[str, dict[str, list[float]]]
+    latencies = collections.defaultdict(lambda: collections.defaultdict(list))
+    for report in reports:
+        if report.cache is not None and report.latency is not None:
+            collection_latencies = latencies[report.request.collection_id]
+            collection_latencies[report.cache].append(report.latency)
+
+    if latencies:
+        typer.echo("CACHE (median latency, cold vs warm):")
+    for collection_id, collection_latencies in sorted(latencies.items()):
+        cold, warm = (
+            f"{statistics.median(values):.3f} s" if values else "n/a"
+            for values in (collection_latencies["cold"], collection_latencies["warm"])
+        )
+        typer.echo(
+            f"  {collection_id}: {cold} vs {warm} "
+            f"({len(collection_latencies['warm'])} pairs)"
+        )
+
+
+def echo_replay_stats(reports: "list[Report]") -> None:
+    lags = [
+        report.submit_offset - report.request.settings.submit_at
+        for report in reports
+        if report.submit_offset is not None
+        and report.request.settings.submit_at is not None
+    ]
+    if lags:
+        typer.echo(
+            "REPLAY LAG (median, max): "
+            f"{statistics.median(lags):.3f} s, {max(lags):.3f} s ({len(lags)} requests)"
+        )
+
+
+def replay(
+    trace_path: Annotated[
+        str,
+        typer.Argument(
+            help="Path to the JSON Lines trace with timestamp, collection_id"
+            " and parameters of each request"
+        ),
+    ],
+    url: Annotated[Optional[str], Option(help="API url")] = None,  # noqa: UP007
+    key: Annotated[list[str], Option(help="API key(s)")] = [],
+    reports_path: Annotated[
+        str, Option(help="Path to write the reports in JSON Lines format")
+    ] = "replay_reports.jsonl",
+    speed: Annotated[
+        float,
+        Option(help="Speed-up factor applied to the recorded inter-arrival times"),
+    ] = 1.0,
+    n_jobs: Annotated[
+        int,
+        Option(
+            help="Maximum number of concurrent requests"
+            " (requests are submitted late when all workers are busy)"
+        ),
+    ] = 100,
+    backend: Annotated[
+        str,
+        Option(help="Backend used to run concurrent requests (loky or threading)"),
+    ] = "threading",
+    verbose: Annotated[
+        int,
+        Option(help="The verbosity level of the progress messages"),
+    ] = 10,
+    log_level: Annotated[
+        str,
+        Option(help="Set the root logger level to the specified level"),
+    ] = "INFO",
+    download: Annotated[
+        bool,
+        Option(help="Whether to download the results"),
+    ] = False,
+    max_runtime: Annotated[
+        float | None,
+        Option(help="Maximum time (in seconds) each request is allowed to run"),
+    ] = None,
+    deadline: Annotated[
+        float | None,
+        Option(
+            help="Maximum wall time (in seconds) of the whole replay"
+            " (requests not submitted in time are skipped)"
+        ),
+    ] = None,
+    client_maximum_tries: Annotated[
+        int,
+        Option(help="Maximum number of retries"),
+    ] = 1,
+    max_request_rate: Annotated[
+        float | None,
+        Option(
+            help="Maximum number of API calls per second shared by all workers",
+            show_default="unlimited",
+        ),
+    ] = None,
+) -> None:
+    """Replay recorded traffic at its original (scaled) inter-arrival times."""
+    from . import models, reporter
+
+    with open(trace_path, "r") as fp:
+        reports = reporter.reports_generator(
+            url=url,
+            keys=key,
+            requests=models.iter_trace_requests(fp, speed=speed),
+            n_jobs=n_jobs,
+            backend=backend,
+            verbose=verbose,
+            log_level=log_level,
+            download=download,
+            max_runtime=max_runtime,
+            deadline=deadline,
+            maximum_tries=client_maximum_tries,
+            max_request_rate=max_request_rate,
+        )
+        dump_and_echo_reports(reports, reports_path)
+
+
+def generate(
+    url: Annotated[Optional[str], Option(help="API url")] = None,  # noqa: UP007
+    key: Annotated[Optional[str], Option(help="API key")] = None,  # noqa: UP007
+    requests_path: Annotated[
+        Optional[str],  # noqa: UP007
+        Option(
+            help="Path to the YAML or JSON Lines file with the request templates",
+            show_default="one empty request per collection",
+        ),
+    ] = None,
+    output_path: Annotated[
+        str,
+        Option(help="Path to write the requests in YAML or JSON Lines (.jsonl) format"),
+    ] = "random_requests.yaml",
+    n_requests: Annotated[
+        int,
+        Option(help="Number of random requests to generate per template"),
+    ] = 1,
+    regex_pattern: Annotated[
+        str,
+        Option(help="Regex pattern used to filter collection IDs"),
+    ] = r"^(?!test-|provider-).*(?<!-complete)$",
+    batch_size: Annotated[
+        int,
+        Option(help="Number of random requests sampled in a single batch"),
+    ] = 1_000,
+    seed: Annotated[
+        Optional[int],  # noqa: UP007
+        Option(help="Seed of the random requests", show_default="random"),
+    ] = None,
+    client_maximum_tries: Annotated[
+        int,
+        Option(help="Maximum number of retries"),
+    ] = 1,
+) -> None:
+    """Generate random requests."""
+    requests = None if requests_path is None else read_requests(requests_path)
+
+    from . import models, reporter
+
+    random_requests = reporter.random_requests_generator(
+        url=url,
+        key=key,
+        requests=requests,
+        n_requests=n_requests,
+        regex_pattern=regex_pattern,
+        batch_size=batch_size,
+        seed=seed,
+        maximum_tries=client_maximum_tries,
+    )
+    n_generated = 0
+    with open(output_path, "w") as fp:
+        if output_path.endswith(".jsonl"):
+            for request in random_requests:
+                models.dump_request(request, fp)
+                n_generated += 1
+        else:
+            generated_requests = list(random_requests)
+            models.dump_requests(generated_requests, fp)
+            n_generated = len(generated_requests)
+    typer.echo(f"NUMBER OF REQUESTS: {n_generated}")
+
+
+class DefaultCommandGroup(TyperGroup):
+    # Arguments not starting with a subcommand are passed to make-reports,
+    # so that `cads-e2e-tests --reports-path ...` keeps working.
+    default_command = "make-reports"
+
+    def parse_args(self, ctx: Any, args: list[str]) -> list[str]:
+        if not args or (args[0] not in self.commands and args[0] != "--help"):
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
+
+app = typer.Typer(cls=DefaultCommandGroup, add_completion=False)
+app.command("make-reports")(make_reports)
+app.command("generate")(generate)
+app.command("replay")(replay)
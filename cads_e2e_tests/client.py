@@ -1,32 +1,67 @@
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
 import functools
+import hashlib
+import json
 import logging
+import os
+import random
+import threading
 import time
-from typing import Any
+from typing import Any, Iterator, MutableMapping
 
 import attrs
-import joblib
 from ecmwf.datastores import Client, Collection, Collections, Remote
+from ecmwf.datastores.utils import string_to_datetime
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
-from . import utils
-from .models import Report, Request
+from . import downloader, exceptions, ratelimit, utils
+from .models import Report, Request, Settings
 
 LOGGER = logging.getLogger(__name__)
 
 
 SLEEP_INCREMENTAL_RATIO = 1.5
+MAX_COST_RESAMPLES = 10
+JOBS_BATCH_SIZE = 100
+JOB_TIMES_FIELDS = {"job_created_at", "job_started_at", "job_finished_at", "queue_time"}
+MAX_BOOTSTRAP_WORKERS = 16
+LICENCES_CACHE_PATH = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "cads-e2e-tests",
+    "accepted_licences.json",
+)
+DOWNLOAD_FIELDS = {
+    "extension",
+    "format",
+    "size",
+    "checksum",
+    "time_to_first_byte",
+    "transfer_time",
+    "throughput",
+    "download_retries",
+}
 
 
 class CollectionUtils(utils.AbstractCollectionUtils):
     def __init__(self, collection: Collection) -> None:
         self.collection = collection
+        self.constraints: dict[str, dict[str, Any]] = {}
 
-    @property
+    @functools.cached_property
     def form(self) -> list[dict[str, Any]]:
         return self.collection.form
 
     def apply_constraints(self, parameters: dict[str, Any]) -> dict[str, Any]:
-        return self.collection.apply_constraints(parameters)
+        key = json.dumps(parameters, sort_keys=True)
+        if (constraints := self.constraints.get(key)) is None:
+            constraints = self.constraints[key] = self.collection.apply_constraints(
+                parameters
+            )
+        return copy.deepcopy(constraints)
 
 
 def _licences_to_set_of_tuples(
@@ -35,6 +70,47 @@ def _licences_to_set_of_tuples(
     return {(licence["id"], licence["revision"]) for licence in licences}
 
 
+_LICENCES: dict[str | None, set[tuple[str, int]]] = {}
+_LICENCES_LOCK = threading.Lock()
+
+
+def get_public_licences(client: Client) -> set[tuple[str, int]]:
+    # The public licences are fetched once per API url and shared by all keys
+    with _LICENCES_LOCK:
+        if (licences := _LICENCES.get(client.url)) is None:
+            licences = _LICENCES[client.url] = _licences_to_set_of_tuples(
+                client.get_licences()
+            )
+    return licences
+
+
+def _load_accepted_licences(path: str) -> dict[str, set[tuple[str, int]]]:
+    try:
+        with open(path, "r") as fp:
+            return {
+                fingerprint: {(licence_id, revision) for licence_id, revision in value}
+                for fingerprint, value in json.load(fp).items()
+            }
+    except (OSError, ValueError):
+        return {}
+
+
+def _dump_accepted_licences(
+    accepted_licences: dict[str, set[tuple[str, int]]], path: str
+) -> None:
+    # The cache is best-effort, e.g. the home directory may not be writable
+    with contextlib.suppress(OSError):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as fp:
+            json.dump(
+                {
+                    fingerprint: sorted(licences)
+                    for fingerprint, licences in accepted_licences.items()
+                },
+                fp,
+            )
+
+
 def _get_elapsed_time(remote: Remote, max_replication_lag: float) -> float:
     assert max_replication_lag >= 0
     replication_lag = 0.0
@@ -51,16 +127,106 @@ def _get_elapsed_time(remote: Remote, max_replication_lag: float) -> float:
     raise TimeoutError("Maximum replication lag exceeded.")
 
 
+def get_elapsed_time_from_json(job: dict[str, Any]) -> float | None:
+    if (started := job.get("started")) and (finished := job.get("finished")):
+        timedelta = string_to_datetime(finished) - string_to_datetime(started)
+        return timedelta.total_seconds()
+    return None
+
+
+def get_job_times(job: dict[str, Any]) -> dict[str, Any]:
+    created_at, started_at, finished_at = (
+        None if (value := job.get(key)) is None else string_to_datetime(value)
+        for key in ("created", "started", "finished")
+    )
+    queue_time = None
+    if created_at is not None and started_at is not None:
+        queue_time = (started_at - created_at).total_seconds()
+    return {
+        "job_created_at": created_at,
+        "job_started_at": started_at,
+        "job_finished_at": finished_at,
+        "queue_time": queue_time,
+    }
+
+
+def _exceeds_budget(costs: dict[str, Any], max_cost: float | None) -> bool:
+    # Without an explicit budget, requests are checked against the server limit
+    budget = costs.get("limit") if max_cost is None else max_cost
+    return budget is not None and costs["cost"] > budget
+
+
+def _check_cost(costs: dict[str, Any], max_cost: float | None) -> None:
+    if _exceeds_budget(costs, max_cost):
+        expected = costs.get("limit") if max_cost is None else max_cost
+        raise exceptions.CostError(actual=costs["cost"], expected=expected)
+
+
+def _poll_job(remote: Remote) -> dict[str, Any]:
+    # Like Remote.status, but returns the whole job. Server logs are relayed on
+    # each poll, and only fetched from the last log time onwards.
+    job = remote.json
+    remote._log_metadata(job.get("metadata", {}))
+    if remote.last_status != (status := job["status"]):
+        remote.info(f"status has been updated to {status}")
+    remote.last_status = status
+    return job
+
+
+def finalise_report(report: Report) -> Report:
+    tracebacks = report.tracebacks or report.run_checks()
+    return Report(
+        tracebacks=tracebacks,
+        **report.model_dump(exclude={"tracebacks", "finished_at"}),
+    )
+
+
 @attrs.define
 class TestClient(Client):
     __test__ = False
 
+    chunk_size: int = downloader.CHUNK_SIZE
+    download_connections: int = 1
+    download_part_size: int = downloader.PART_SIZE
+    download_sample_size: int | None = None
+    pool_connections: int = DEFAULT_POOLSIZE
+    pool_maxsize: int = DEFAULT_POOLSIZE
+    max_request_rate: float | None = None
+    costs: dict[str, dict[str, Any]] = attrs.field(factory=dict, init=False, repr=False)
+    rate_limiter: ratelimit.RateLimiter = attrs.field(init=False, repr=False)
+    live_request_uids: set[str] = attrs.field(factory=set, init=False, repr=False)
+    live_requests_lock: threading.Lock = attrs.field(
+        factory=threading.Lock, init=False, repr=False
+    )
+
+    def __attrs_post_init__(self) -> None:
+        pool_kwargs: dict[str, Any] = {
+            "pool_connections": self.pool_connections,
+            "pool_maxsize": self.pool_maxsize,
+        }
+        adapter = HTTPAdapter(**pool_kwargs)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        super().__attrs_post_init__()
+
+        # API calls (submissions, status, results) share the process rate limiter
+        assert self.url is not None
+        self.rate_limiter = ratelimit.get_rate_limiter(self.max_request_rate)
+        self.session.mount(
+            self.url, ratelimit.RateLimitedAdapter(self.rate_limiter, **pool_kwargs)
+        )
+
+    @property
+    def fingerprint(self) -> str:
+        # Identifies the key in the licences cache without storing it in clear
+        return hashlib.sha256(f"{self.url} {self.key}".encode()).hexdigest()
+
     @functools.cached_property
     def missing_licences(self) -> set[tuple[str, int]]:
         if self.check_authentication().get("role") == "anonymous":
             return set()
 
-        licences = _licences_to_set_of_tuples(self.get_licences())
+        licences = get_public_licences(self)
         accepted_licences = _licences_to_set_of_tuples(self.get_accepted_licences())
         return licences - accepted_licences
 
@@ -83,132 +249,442 @@ class TestClient(Client):
         ]
 
     def random_parameters(
-        self, collection_id: str, parameters: dict[str, Any]
+        self,
+        collection_id: str,
+        parameters: dict[str, Any],
+        rng: random.Random | None = None,
     ) -> dict[str, Any]:
         collection = self.get_collection(collection_id)
         collection_utils = CollectionUtils(collection)
-        return collection_utils.random_parameters(parameters)
+        return collection_utils.random_parameters(parameters, rng=rng)
+
+    def random_requests(
+        self, request: Request, size: int, seed: int | None = None
+    ) -> Iterator[Request]:
+        collection_utils = CollectionUtils(self.get_collection(request.collection_id))
+        for parameters in collection_utils.random_parameters_batch(
+            dict(request.parameters), size, seed
+        ):
+            settings = Settings(
+                randomise=False, **request.settings.model_dump(exclude={"randomise"})
+            )
+            yield Request(
+                parameters=parameters,
+                settings=settings,
+                **request.model_dump(exclude={"parameters", "settings"}),
+            )
+
+    def estimate_request_costs(
+        self, collection_id: str, parameters: dict[str, Any]
+    ) -> dict[str, Any]:
+        key = json.dumps([collection_id, parameters], sort_keys=True)
+        if (costs := self.costs.get(key)) is None:
+            costs = self.costs[key] = self.estimate_costs(collection_id, parameters)
+        return costs
 
     def update_request_parameters(
         self,
         request: Request,
         cache_key: str | None,
-    ) -> Request:
+        estimate_costs: bool = False,
+        max_cost: float | None = None,
+    ) -> tuple[Request, dict[str, Any] | None]:
         parameters = dict(request.parameters)
 
         randomise = request.settings.randomise
         if randomise is None:
             randomise = not parameters
 
-        if randomise:
-            parameters = self.random_parameters(request.collection_id, parameters)
+        estimate_costs = estimate_costs or max_cost is not None
+        costs = None
+        rng = random.Random(request.settings.seed)
+        for _ in range(MAX_COST_RESAMPLES if randomise and estimate_costs else 1):
+            if randomise:
+                parameters = self.random_parameters(
+                    request.collection_id, dict(request.parameters), rng
+                )
+            if not estimate_costs:
+                break
+            costs = self.estimate_request_costs(request.collection_id, parameters)
+            if not _exceeds_budget(costs, max_cost):
+                break
 
         if cache_key is not None:
             parameters.setdefault(cache_key, datetime.datetime.now().isoformat())
 
-        return Request(
+        request = Request(
             parameters=parameters,
             **request.model_dump(exclude={"parameters"}),
         )
+        return request, costs
+
+    def get_jobs_by_id(self, *request_ids: str) -> dict[str, dict[str, Any]]:
+        # Recent jobs are fetched in one call, older ones one by one
+        jobs = self.get_jobs(limit=JOBS_BATCH_SIZE, sortby="-created").json
+        jobs_by_id = {job["jobID"]: job for job in jobs.get("jobs", [])}
+        return {
+            request_id: jobs_by_id.get(request_id) or self.get_remote(request_id).json
+            for request_id in request_ids
+        }
+
+    def _track_request(self, request_id: str, live: bool) -> None:
+        with self.live_requests_lock:
+            if live:
+                self.live_request_uids.add(request_id)
+            else:
+                self.live_request_uids.discard(request_id)
+        _share_live_request(request_id, self.fingerprint if live else None)
+
+    def cancel_requests(self, *request_ids: str) -> int:
+        with self.live_requests_lock:
+            request_ids = tuple(set(request_ids) & self.live_request_uids)
+            self.live_request_uids.difference_update(request_ids)
+        for request_id in request_ids:
+            _share_live_request(request_id, None)
+        return self.delete_requests(*request_ids)
+
+    def delete_requests(self, *request_ids: str) -> int:
+        if not request_ids:
+            return 0
+
+        tracebacks: list[str] = []
+        with utils.catch_exceptions(tracebacks, logger=LOGGER):
+            self.delete(*request_ids)
+        return 0 if tracebacks else len(request_ids)
+
+    def cancel_live_requests(self) -> int:
+        with self.live_requests_lock:
+            request_ids = list(self.live_request_uids)
+        return self.cancel_requests(*request_ids)
 
     def wait_on_results_with_timeout(
-        self, remote: Remote, max_runtime: float | None
-    ) -> None:
+        self,
+        remote: Remote,
+        max_runtime: float | None,
+        max_queue_time: float | None = None,
+        total_deadline: float | None = None,
+        run_deadline: float | None = None,
+        status_history: list[tuple[float, str]] | None = None,
+    ) -> dict[str, Any]:
+        # The job is fetched once per poll, and status changes are recorded as
+        # (seconds since submission, status) pairs.
         sleep = 1.0
-        while not remote.results_ready:
-            if (
-                max_runtime is not None
-                and (started_at := remote.started_at) is not None
+        queued_at = time.time()
+        deadlines = [d for d in (total_deadline, run_deadline) if d is not None]
+        while True:
+            job = _poll_job(remote)
+            now = time.time()
+            status = job["status"]
+            if status_history is not None and (
+                not status_history or status_history[-1][1] != status
             ):
+                status_history.append((round(now - queued_at, 3), status))
+            if status == "successful":
+                return job
+            if status not in ("accepted", "running") and remote.results_ready:
+                # results_ready raises on failed, rejected, or deleted jobs
+                return remote.json
+
+            if total_deadline is not None and now > total_deadline:
+                raise exceptions.TotalTimeoutError("Maximum total time exceeded.")
+            if run_deadline is not None and now > run_deadline:
+                raise exceptions.DeadlineTimeoutError("Run deadline exceeded.")
+            if (started := job.get("started")) is None:
+                if max_queue_time is not None and now - queued_at > max_queue_time:
+                    raise exceptions.QueueTimeoutError("Maximum queue time exceeded.")
+            elif max_runtime is not None:
+                started_at = string_to_datetime(started)
                 if started_at.tzinfo is None:
                     started_at = started_at.replace(tzinfo=datetime.timezone.utc)
                 timedelta = datetime.datetime.now(datetime.timezone.utc) - started_at
                 if timedelta.total_seconds() > max_runtime:
-                    raise TimeoutError("Maximum runtime exceeded.")
-            time.sleep(sleep)
+                    raise exceptions.RuntimeTimeoutError("Maximum runtime exceeded.")
+            time.sleep(max(min([sleep, *(d - now for d in deadlines)]), 0))
             sleep = min(sleep * SLEEP_INCREMENTAL_RATIO, self.sleep_max)
 
-    def make_report(
+    def make_partial_report(
         self,
         request: Request,
         cache_key: str | None,
-        download: bool,
         max_runtime: float | None,
         max_replication_lag: float,
         get_elapsed_time: bool,
-    ) -> Report:
+        estimate_costs: bool = False,
+        max_cost: float | None = None,
+        max_queue_time: float | None = None,
+        max_total_time: float | None = None,
+        run_deadline: float | None = None,
+        defer_elapsed_time: bool = False,
+    ) -> tuple[Report, str | None]:
         if request.settings.max_runtime is not None:
             max_runtime = request.settings.max_runtime
+        if request.settings.max_queue_time is not None:
+            max_queue_time = request.settings.max_queue_time
+        if request.settings.max_total_time is not None:
+            max_total_time = request.settings.max_total_time
+        if request.settings.max_cost is not None:
+            max_cost = request.settings.max_cost
+        total_deadline = (
+            None if max_total_time is None else time.time() + max_total_time
+        )
 
         report = Report(request=request)
+        location = None
+        n_throttled = self.rate_limiter.n_throttled
 
         tracebacks: list[str] = []
         with utils.catch_exceptions(tracebacks, logger=LOGGER):
-            request = self.update_request_parameters(request, cache_key)
+            request, costs = self.update_request_parameters(
+                request, cache_key, estimate_costs=estimate_costs, max_cost=max_cost
+            )
             report = Report(
                 request=request,
-                **report.model_dump(exclude={"request"}),
+                cost=None if costs is None else costs["cost"],
+                **report.model_dump(exclude={"request", "cost"}),
             )
+            if costs is not None:
+                _check_cost(costs, max_cost)
 
+            if run_deadline is not None and time.time() > run_deadline:
+                report = Report(
+                    timeout=exceptions.DeadlineTimeoutError.limit,
+                    **report.model_dump(exclude={"timeout"}),
+                )
+                raise exceptions.DeadlineTimeoutError("Run deadline exceeded.")
+
+            tic = time.perf_counter()
             remote = self.submit(request.collection_id, request.parameters)
             report = Report(
                 request_uid=remote.request_id,
                 **report.model_dump(exclude={"request_uid"}),
             )
 
-            self.wait_on_results_with_timeout(remote, max_runtime)
+            # Jobs are tracked until completion, so that they can be deleted from
+            # the server on timeout or interrupt.
+            self._track_request(remote.request_id, live=True)
+            status_history: list[tuple[float, str]] = []
+            try:
+                job = self.wait_on_results_with_timeout(
+                    remote,
+                    max_runtime,
+                    max_queue_time=max_queue_time,
+                    total_deadline=total_deadline,
+                    run_deadline=run_deadline,
+                    status_history=status_history,
+                )
+            except exceptions.RequestTimeoutError as exc:
+                report = Report(
+                    cancelled=bool(self.cancel_requests(remote.request_id)),
+                    timeout=exc.limit,
+                    **report.model_dump(exclude={"cancelled", "timeout"}),
+                )
+                raise
+            except Exception:
+                self._track_request(remote.request_id, live=False)
+                raise
+            finally:
+                report = Report(
+                    status_history=status_history,
+                    **report.model_dump(exclude={"status_history"}),
+                )
+            self._track_request(remote.request_id, live=False)
             results = remote.get_results()
-
-            elapsed_time = (
-                _get_elapsed_time(remote, max_replication_lag)
-                if get_elapsed_time
-                else None
+            report = Report(
+                latency=time.perf_counter() - tic,
+                **get_job_times(job),
+                **report.model_dump(exclude={"latency", *JOB_TIMES_FIELDS}),
             )
 
+            if not get_elapsed_time:
+                elapsed_time = None
+            elif defer_elapsed_time:
+                # Missing timestamps are resolved later by the caller
+                elapsed_time = get_elapsed_time_from_json(job)
+            else:
+                elapsed_time = _get_elapsed_time(remote, max_replication_lag)
+
             report = Report(
                 time=elapsed_time,
                 content_length=results.content_length,
                 content_type=results.content_type,
                 **report.model_dump(exclude={"time", "content_length", "content_type"}),
             )
-            if download:
-                target_info = utils.TargetInfo(results.download())
-                report = Report(
-                    extension=target_info.extension,
-                    size=target_info.size,
-                    checksum=target_info.checksum,
-                    **report.model_dump(exclude={"extension", "size", "checksum"}),
-                )
+            location = results.location
+
+        report = Report(
+            tracebacks=tracebacks,
+            throttled=self.rate_limiter.n_throttled - n_throttled,
+            **report.model_dump(exclude={"tracebacks", "throttled"}),
+        )
+        return report, location
+
+    def sample_report(self, report: Report, location: str) -> Report:
+        assert self.download_sample_size is not None
+        tracebacks = list(report.tracebacks)
+        with utils.catch_exceptions(tracebacks, logger=LOGGER):
+            sample_info = downloader.sample(
+                self.session,
+                location,
+                content_length=report.content_length,
+                sample_size=self.download_sample_size,
+                **self._request_options,
+            )
+            report = Report(
+                extension=sample_info.extension,
+                format=sample_info.format,
+                time_to_first_byte=sample_info.time_to_first_byte,
+                **report.model_dump(exclude=DOWNLOAD_FIELDS),
+            )
+
+        return Report(
+            tracebacks=tracebacks,
+            **report.model_dump(exclude={"tracebacks"}),
+        )
 
-        if not tracebacks:
-            tracebacks = report.run_checks()
+    def download_report(
+        self, report: Report, location: str, target: str | None = None
+    ) -> Report:
+        checks = report.request.checks
+        if (
+            self.download_sample_size is not None
+            and checks.checksum is None
+            and checks.size is None
+        ):
+            return self.sample_report(report, location)
+
+        tracebacks = list(report.tracebacks)
+        with utils.catch_exceptions(tracebacks, logger=LOGGER):
+            download_info = downloader.download(
+                self.session,
+                location,
+                target=target,
+                content_length=report.content_length,
+                chunk_size=self.chunk_size,
+                connections=self.download_connections,
+                part_size=self.download_part_size,
+                maximum_tries=self.maximum_tries,
+                retry_after=self.retry_after,
+                **self._request_options,
+            )
+            report = Report(
+                extension=download_info.extension,
+                format=download_info.format,
+                size=download_info.size,
+                checksum=download_info.checksum,
+                time_to_first_byte=download_info.time_to_first_byte,
+                transfer_time=download_info.transfer_time,
+                throughput=download_info.throughput,
+                download_retries=download_info.n_retries,
+                **report.model_dump(exclude=DOWNLOAD_FIELDS),
+            )
 
         return Report(
             tracebacks=tracebacks,
-            **report.model_dump(exclude={"tracebacks", "finished_at"}),
+            **report.model_dump(exclude={"tracebacks"}),
         )
 
-    @joblib.delayed  # type: ignore[untyped-decorator]
-    def delayed_make_report(
+    def make_report(
         self,
         request: Request,
         cache_key: str | None,
         download: bool,
         max_runtime: float | None,
-        log_level: str | None,
         max_replication_lag: float,
         get_elapsed_time: bool,
-        working_dir: str | None,
+        **kwargs: Any,
     ) -> Report:
-        if log_level is not None:
-            logging.basicConfig(level=log_level.upper())
-
-        with utils.tmp_working_dir(working_dir):
-            return self.make_report(
-                request=request,
-                cache_key=cache_key,
-                download=download,
-                max_runtime=max_runtime,
-                max_replication_lag=max_replication_lag,
-                get_elapsed_time=get_elapsed_time,
+        report, location = self.make_partial_report(
+            request=request,
+            cache_key=cache_key,
+            max_runtime=max_runtime,
+            max_replication_lag=max_replication_lag,
+            get_elapsed_time=get_elapsed_time,
+            **kwargs,
+        )
+        if download and location is not None:
+            report = self.download_report(report, location)
+        return finalise_report(report)
+
+
+_TEST_CLIENTS: dict[tuple[tuple[str, Any], ...], TestClient] = {}
+_TEST_CLIENTS_LOCK = threading.Lock()
+
+# Live jobs of worker processes, mapping request uids to client fingerprints,
+# shared with the parent process so that it can delete them.
+_SHARED_LIVE_REQUESTS: MutableMapping[str, str] | None = None
+
+
+def share_live_requests(shared_live_requests: MutableMapping[str, str] | None) -> None:
+    global _SHARED_LIVE_REQUESTS
+    _SHARED_LIVE_REQUESTS = shared_live_requests
+
+
+def _share_live_request(request_id: str, fingerprint: str | None) -> None:
+    if (shared_live_requests := _SHARED_LIVE_REQUESTS) is None:
+        return
+    # The parent process may have shut the mapping down already
+    with contextlib.suppress(OSError, EOFError):
+        if fingerprint is None:
+            shared_live_requests.pop(request_id, None)
+        else:
+            shared_live_requests[request_id] = fingerprint
+
+
+def cancel_live_requests() -> int:
+    with _TEST_CLIENTS_LOCK:
+        clients = list(_TEST_CLIENTS.values())
+    return sum(client.cancel_live_requests() for client in clients)
+
+
+def cancel_shared_live_requests(
+    clients: list[TestClient], shared_live_requests: MutableMapping[str, str]
+) -> int:
+    # Live jobs of worker processes are deleted with the clients of this process
+    request_ids = collections.defaultdict(list)
+    for request_id, fingerprint in list(shared_live_requests.items()):
+        request_ids[fingerprint].append(request_id)
+    n_cancelled = 0
+    for client in clients:
+        if fingerprint_request_ids := request_ids.pop(client.fingerprint, None):
+            for request_id in fingerprint_request_ids:
+                shared_live_requests.pop(request_id, None)
+            n_cancelled += client.delete_requests(*fingerprint_request_ids)
+    return n_cancelled
+
+
+def accept_all_missing_licences(
+    clients: list[TestClient], cache_path: str | None = None
+) -> None:
+    # Licences are accepted concurrently across keys. Keys whose licences are
+    # all accepted according to the cache skip the profile API calls.
+    cached_licences = {} if cache_path is None else _load_accepted_licences(cache_path)
+
+    def accept(client: TestClient) -> set[tuple[str, int]]:
+        licences = get_public_licences(client)
+        if not licences <= cached_licences.get(client.fingerprint, set()):
+            client.accept_all_missing_licences()
+        return licences
+
+    if not clients:
+        return
+    max_workers = min(len(clients), MAX_BOOTSTRAP_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        accepted_licences = dict(
+            zip(
+                (client.fingerprint for client in clients),
+                executor.map(accept, clients),
             )
+        )
+    if cache_path is not None:
+        _dump_accepted_licences(cached_licences | accepted_licences, cache_path)
+
+
+def get_test_client(**kwargs: Any) -> TestClient:
+    # Clients are cached per process, so that workers reuse the same HTTP
+    # connections across tasks. Threads of the same process share one client
+    # per key, hence its connection pool must be sized for all of them.
+    key = tuple(sorted(kwargs.items()))
+    with _TEST_CLIENTS_LOCK:
+        if (client := _TEST_CLIENTS.get(key)) is None:
+            client = _TEST_CLIENTS[key] = TestClient(**kwargs)
+    return client
@@ -0,0 +1,365 @@
+import collections
+import concurrent.futures
+import dataclasses
+import hashlib
+import os
+import time
+import urllib.parse
+from typing import TYPE_CHECKING, Any, BinaryIO
+
+if TYPE_CHECKING:
+    import requests
+
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = 64 * 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+MAGIC_NUMBERS = {
+    b"GRIB": "grib",
+    b"CDF\x01": "netcdf",
+    b"CDF\x02": "netcdf",
+    b"CDF\x05": "netcdf",
+    b"\x89HDF\r\n\x1a\n": "hdf5",
+    b"PK\x03\x04": "zip",
+    b"PK\x05\x06": "zip",
+}
+
+
+def _download_error(message: str) -> Exception:
+    from ecmwf.datastores.processing import DownloadError
+
+    return DownloadError(message)
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+def _is_transient_error(exc: Exception) -> bool:
+    import requests
+
+    if isinstance(exc, requests.HTTPError):
+        return (
+            exc.response is not None and exc.response.status_code in RETRY_STATUS_CODES
+        )
+    return isinstance(
+        exc,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def _wait_before_retry(n_retries: int, retry_after: float) -> None:
+    time.sleep(min(2 ** (n_retries - 1), retry_after))
+
+
+@dataclasses.dataclass
+class DownloadInfo:
+    target: str
+    size: int
+    checksum: str
+    format: str | None
+    time_to_first_byte: float
+    transfer_time: float
+    n_retries: int = 0
+
+    @property
+    def extension(self) -> str:
+        _, extension = os.path.splitext(self.target)
+        return extension
+
+    @property
+    def throughput(self) -> float | None:
+        if not self.transfer_time:
+            return None
+        return self.size / self.transfer_time
+
+
+@dataclasses.dataclass
+class SampleInfo:
+    target: str
+    content: bytes
+    content_length: int | None
+    time_to_first_byte: float
+
+    @property
+    def extension(self) -> str:
+        _, extension = os.path.splitext(self.target)
+        return extension
+
+    @property
+    def format(self) -> str | None:
+        return sniff_format(self.content)
+
+
+def sniff_format(content: bytes) -> str | None:
+    for magic_number, format in MAGIC_NUMBERS.items():
+        if content.startswith(magic_number):
+            return format
+    return None
+
+
+def target_from_url(url: str) -> str:
+    parts = urllib.parse.urlparse(url)
+    return parts.path.strip("/").split("/")[-1]
+
+
+def _get_range(
+    session: "requests.Session",
+    url: str,
+    start: int,
+    stop: int,
+    chunk_size: int,
+    maximum_tries: int = 1,
+    retry_after: float = 0.0,
+    **request_options: Any,
+) -> tuple[bytes, float, int]:
+    # Parts interrupted by transient errors are downloaded again
+    headers = {"Range": f"bytes={start}-{stop - 1}"}
+    n_retries = 0
+    while True:
+        tic = time.perf_counter()
+        try:
+            with session.get(
+                url, headers=headers, stream=True, **request_options
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RangeNotSupportedError(url)
+                time_to_first_byte = time.perf_counter() - tic
+                content = b"".join(response.iter_content(chunk_size=chunk_size))
+            break
+        except Exception as exc:
+            n_retries += 1
+            if n_retries >= maximum_tries or not _is_transient_error(exc):
+                raise
+        _wait_before_retry(n_retries, retry_after)
+    if len(content) != stop - start:
+        raise _download_error(
+            f"Download failed: downloaded {len(content)} byte(s) of range {start}-{stop - 1}"
+        )
+    return content, time_to_first_byte, n_retries
+
+
+def _download_stream(
+    session: "requests.Session",
+    url: str,
+    f: BinaryIO,
+    digest: "hashlib._Hash",
+    chunk_size: int,
+    maximum_tries: int = 1,
+    retry_after: float = 0.0,
+    **request_options: Any,
+) -> tuple[float | None, int]:
+    # Streams interrupted by transient errors are resumed from the last byte
+    # written. Bytes sent again by servers ignoring the range are skipped.
+    tic = time.perf_counter()
+    time_to_first_byte = None
+    n_retries = 0
+    while True:
+        written = f.tell()
+        headers = {"Range": f"bytes={written}-"} if written else {}
+        try:
+            with session.get(
+                url, headers=headers, stream=True, **request_options
+            ) as response:
+                if written and response.status_code == 416:
+                    # Range Not Satisfiable: the whole content was written
+                    return time_to_first_byte, n_retries
+                response.raise_for_status()
+                skip = 0 if response.status_code == 206 else written
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if time_to_first_byte is None:
+                        time_to_first_byte = time.perf_counter() - tic
+                    if skip:
+                        chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                    f.write(chunk)
+                    digest.update(chunk)
+            return time_to_first_byte, n_retries
+        except Exception as exc:
+            n_retries += 1
+            if n_retries >= maximum_tries or not _is_transient_error(exc):
+                raise
+        _wait_before_retry(n_retries, retry_after)
+
+
+def _download_parts(
+    session: "requests.Session",
+    url: str,
+    f: BinaryIO,
+    digest: "hashlib._Hash",
+    content_length: int,
+    part_size: int,
+    connections: int,
+    chunk_size: int,
+    **request_options: Any,
+) -> tuple[float | None, int]:
+    # Parts are written and hashed in order, so at most `connections` parts are
+    # held in memory at any time.
+    time_to_first_byte = None
+    n_retries = 0
+    futures: collections.deque[concurrent.futures.Future[tuple[bytes, float, int]]]
+    futures = collections.deque()
+
+    def write_next_part() -> None:
+        nonlocal time_to_first_byte, n_retries
+        content, part_time_to_first_byte, part_n_retries = futures.popleft().result()
+        if time_to_first_byte is None:
+            time_to_first_byte = part_time_to_first_byte
+        n_retries += part_n_retries
+        f.write(content)
+        digest.update(content)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        try:
+            for start in range(0, content_length, part_size):
+                if len(futures) >= connections:
+                    write_next_part()
+                stop = min(start + part_size, content_length)
+                futures.append(
+                    executor.submit(
+                        _get_range,
+                        session,
+                        url,
+                        start,
+                        stop,
+                        chunk_size,
+                        **request_options,
+                    )
+                )
+            while futures:
+                write_next_part()
+        finally:
+            for future in futures:
+                future.cancel()
+    return time_to_first_byte, n_retries
+
+
+def download(
+    session: "requests.Session",
+    url: str,
+    target: str | None = None,
+    content_length: int | None = None,
+    chunk_size: int = CHUNK_SIZE,
+    connections: int = 1,
+    part_size: int = PART_SIZE,
+    maximum_tries: int = 1,
+    retry_after: float = 0.0,
+    **request_options: Any,
+) -> DownloadInfo:
+    if target is None:
+        target = target_from_url(url)
+
+    use_ranges = (
+        connections > 1 and content_length is not None and content_length > part_size
+    )
+    tic = time.perf_counter()
+    digest = hashlib.md5()
+    with open(target, "wb") as f:
+        if use_ranges:
+            assert content_length is not None
+            try:
+                time_to_first_byte, n_retries = _download_parts(
+                    session,
+                    url,
+                    f,
+                    digest,
+                    content_length=content_length,
+                    part_size=part_size,
+                    connections=connections,
+                    chunk_size=chunk_size,
+                    maximum_tries=maximum_tries,
+                    retry_after=retry_after,
+                    **request_options,
+                )
+            except RangeNotSupportedError:
+                use_ranges = False
+                f.seek(0)
+                f.truncate()
+                digest = hashlib.md5()
+        if not use_ranges:
+            time_to_first_byte, n_retries = _download_stream(
+                session,
+                url,
+                f,
+                digest,
+                chunk_size,
+                maximum_tries=maximum_tries,
+                retry_after=retry_after,
+                **request_options,
+            )
+        size = f.tell()
+    transfer_time = time.perf_counter() - tic
+    if time_to_first_byte is None:
+        time_to_first_byte = transfer_time
+
+    if content_length is not None and size != content_length:
+        raise _download_error(
+            f"Download failed: downloaded {size} byte(s) out of {content_length}"
+        )
+
+    with open(target, "rb") as f:
+        format = sniff_format(f.read(max(map(len, MAGIC_NUMBERS))))
+
+    return DownloadInfo(
+        target=target,
+        size=size,
+        checksum=digest.hexdigest(),
+        format=format,
+        time_to_first_byte=time_to_first_byte,
+        transfer_time=transfer_time,
+        n_retries=n_retries,
+    )
+
+
+def _content_length_from_headers(response: "requests.Response") -> int | None:
+    if response.status_code in (206, 416):
+        _, _, total = response.headers.get("Content-Range", "").rpartition("/")
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    return None if content_length is None else int(content_length)
+
+
+def sample(
+    session: "requests.Session",
+    url: str,
+    content_length: int | None = None,
+    sample_size: int = SAMPLE_SIZE,
+    **request_options: Any,
+) -> SampleInfo:
+    # Servers ignoring the Range header send the whole file: the stream is closed
+    # as soon as the sample has been collected.
+    tic = time.perf_counter()
+    time_to_first_byte = None
+    chunks: list[bytes] = []
+    headers = {"Range": f"bytes=0-{sample_size - 1}"}
+    with session.get(url, headers=headers, stream=True, **request_options) as response:
+        if response.status_code != 416:  # Range Not Satisfiable: empty file
+            response.raise_for_status()
+            size = 0
+            for chunk in response.iter_content(chunk_size=sample_size):
+                if time_to_first_byte is None:
+                    time_to_first_byte = time.perf_counter() - tic
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= sample_size:
+                    break
+        actual_content_length = _content_length_from_headers(response)
+    if time_to_first_byte is None:
+        time_to_first_byte = time.perf_counter() - tic
+
+    if content_length is not None and actual_content_length != content_length:
+        raise _download_error(
+            f"Download failed: headers report {actual_content_length} byte(s) "
+            f"instead of {content_length}"
+        )
+
+    return SampleInfo(
+        target=target_from_url(url),
+        content=b"".join(chunks)[:sample_size],
+        content_length=actual_content_length,
+        time_to_first_byte=time_to_first_byte,
+    )
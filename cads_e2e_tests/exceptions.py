@@ -1,4 +1,6 @@
-from typing import Any
+from typing import Any, Literal
+
+TimeoutLimit = Literal["runtime", "queue", "total", "deadline"]
 
 
 class CheckError(Exception):
@@ -37,3 +39,47 @@ class ContentLengthError(CheckError):
 
 class ContentTypeError(CheckError):
     pass
+
+
+class FormatError(CheckError):
+    pass
+
+
+class CostError(CheckError):
+    pass
+
+
+class PercentileTimeError(CheckError):
+    pass
+
+
+class ThroughputError(CheckError):
+    pass
+
+
+class FailureRateError(CheckError):
+    pass
+
+
+class RequestTimeoutError(TimeoutError):
+    limit: TimeoutLimit
+
+
+class RuntimeTimeoutError(RequestTimeoutError):
+    limit = "runtime"
+
+
+class QueueTimeoutError(RequestTimeoutError):
+    limit = "queue"
+
+
+class TotalTimeoutError(RequestTimeoutError):
+    limit = "total"
+
+
+class DeadlineTimeoutError(RequestTimeoutError):
+    limit = "deadline"
+
+
+class CircuitOpenError(Exception):
+    pass
@@ -1,9 +1,10 @@
+import collections
 import datetime
 import json
 import logging
-from typing import Any, BinaryIO, ContextManager, TextIO
+import statistics
+from typing import Any, BinaryIO, ContextManager, Iterable, Iterator, Literal, TextIO
 
-import yaml
 from pydantic import BaseModel, Field
 
 from . import exceptions, utils
@@ -21,6 +22,11 @@ class Checks(BaseModel):
     time: float | None = None
     content_length: int | None = None
     content_type: str | None = None
+    format: str | None = None
+    # Aggregate checks, evaluated across all reports of a collection
+    p95_time: float | None = None
+    median_throughput: float | None = None
+    failure_rate: float | None = None
 
     def check_checksum(self, actual: str) -> None:
         expected = self.checksum
@@ -52,10 +58,36 @@ class Checks(BaseModel):
         if expected is not None and actual != expected:
             raise exceptions.ContentTypeError(actual=actual, expected=expected)
 
+    def check_format(self, actual: str | None) -> None:
+        expected = self.format
+        if expected is not None and actual != expected:
+            raise exceptions.FormatError(actual=actual, expected=expected)
+
+    def check_p95_time(self, actual: float) -> None:
+        expected = self.p95_time
+        if expected is not None and actual > expected:
+            raise exceptions.PercentileTimeError(actual=actual, expected=expected)
+
+    def check_median_throughput(self, actual: float) -> None:
+        expected = self.median_throughput
+        if expected is not None and actual < expected:
+            raise exceptions.ThroughputError(actual=actual, expected=expected)
+
+    def check_failure_rate(self, actual: float) -> None:
+        expected = self.failure_rate
+        if expected is not None and actual > expected:
+            raise exceptions.FailureRateError(actual=actual, expected=expected)
+
 
 class Settings(BaseModel):
     max_runtime: float | None = None
+    max_queue_time: float | None = None
+    max_total_time: float | None = None
+    max_cost: float | None = None
     randomise: bool | None = None
+    seed: int | None = None
+    weight: float = Field(default=1.0, ge=0)
+    submit_at: float | None = None
 
 
 class Request(BaseModel):
@@ -75,8 +107,27 @@ class Report(BaseModel):
     content_length: int | None = None
     content_type: str | None = None
     extension: str | None = None
+    format: str | None = None
     size: int | None = None
     time: float | None = None
+    time_to_first_byte: float | None = None
+    transfer_time: float | None = None
+    throughput: float | None = None
+    download_retries: int = 0
+    cost: float | None = None
+    latency: float | None = None
+    cache: Literal["cold", "warm"] | None = None
+    paired_request_uid: str | None = None
+    throttled: int = 0
+    cancelled: bool = False
+    timeout: exceptions.TimeoutLimit | None = None
+    job_created_at: datetime.datetime | None = None
+    job_started_at: datetime.datetime | None = None
+    job_finished_at: datetime.datetime | None = None
+    queue_time: float | None = None
+    status_history: list[tuple[float, str]] = []
+    submit_offset: float | None = None
+    skipped: bool = False
 
     def catch_exceptions(self, tracebacks: list[str]) -> ContextManager[None]:
         return utils.catch_exceptions(
@@ -100,6 +151,10 @@ class Report(BaseModel):
             with self.catch_exceptions(tracebacks=tracebacks):
                 self.request.checks.check_extension(self.extension)
 
+        if self.extension is not None:
+            with self.catch_exceptions(tracebacks=tracebacks):
+                self.request.checks.check_format(self.format)
+
         if self.size is not None:
             with self.catch_exceptions(tracebacks=tracebacks):
                 self.request.checks.check_size(self.size)
@@ -111,25 +166,115 @@ class Report(BaseModel):
         return tracebacks
 
 
+AGGREGATE_CHECKS = {"p95_time", "median_throughput", "failure_rate"}
+
+
+def _p95(values: list[float]) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[94]
+
+
+def run_aggregate_checks(
+    reports: Iterable[Report], checks: Checks | None = None
+) -> dict[str, list[str]]:
+    # Reports are grouped by collection and aggregate thresholds, which are taken
+    # from each request unless checks are given.
+    groups: dict[tuple[str, str], list[Report]] = collections.defaultdict(list)
+    for report in reports:
+        group_checks = report.request.checks if checks is None else checks
+        thresholds = group_checks.model_dump(include=AGGREGATE_CHECKS)
+        if any(value is not None for value in thresholds.values()):
+            key = json.dumps(thresholds, sort_keys=True)
+            groups[(report.request.collection_id, key)].append(report)
+
+    tracebacks: dict[str, list[str]] = {}
+    for (collection_id, key), group in groups.items():
+        group_checks = Checks(**json.loads(key))
+        group_tracebacks = tracebacks.setdefault(collection_id, [])
+        catch_exceptions = group[0].catch_exceptions
+
+        if times := [report.time for report in group if report.time is not None]:
+            with catch_exceptions(group_tracebacks):
+                group_checks.check_p95_time(_p95(times))
+
+        if throughputs := [report.throughput for report in group if report.throughput]:
+            with catch_exceptions(group_tracebacks):
+                group_checks.check_median_throughput(
+                    statistics.median(throughputs) / 1e6
+                )
+
+        failure_rate = (
+            100 * sum(bool(report.tracebacks) for report in group) / len(group)
+        )
+        with catch_exceptions(group_tracebacks):
+            group_checks.check_failure_rate(failure_rate)
+
+    return {k: v for k, v in tracebacks.items() if v}
+
+
 def load_reports(fp: TextIO | BinaryIO) -> list[Report]:
     return [Report(**json.loads(line.strip())) for line in fp]
 
 
-def dump_report(report: Report, fp: TextIO) -> None:
+def _dump_json_line(model: BaseModel, fp: TextIO) -> None:
     try:
         import pydantic_core
     except ImportError:
         from pydantic.json import pydantic_encoder
 
-        json.dump(report, fp, default=pydantic_encoder)
+        json.dump(model, fp, default=pydantic_encoder)
     else:
-        json.dump(pydantic_core.to_jsonable_python(report), fp)
+        json.dump(pydantic_core.to_jsonable_python(model), fp)
     fp.write("\n")
 
 
+def dump_report(report: Report, fp: TextIO) -> None:
+    _dump_json_line(report, fp)
+
+
+def dump_request(request: Request, fp: TextIO) -> None:
+    _dump_json_line(request, fp)
+
+
+def iter_requests(fp: TextIO | BinaryIO) -> Iterator[Request]:
+    for line in fp:
+        if line.strip():
+            yield Request(**json.loads(line))
+
+
+def _trace_timestamp(value: str | float) -> float:
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+def iter_trace_requests(fp: TextIO | BinaryIO, speed: float = 1.0) -> Iterator[Request]:
+    # Trace records (timestamp, collection_id, parameters) are expected in
+    # chronological order, and are submitted at their scaled offset.
+    assert speed > 0
+    start = None
+    for line in fp:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        timestamp = _trace_timestamp(record.pop("timestamp"))
+        start = timestamp if start is None else start
+        settings = Settings(
+            **record.pop("settings", {})
+            | {"randomise": False, "submit_at": (timestamp - start) / speed}
+        )
+        yield Request(settings=settings, **record)
+
+
 def load_requests(fp: TextIO | BinaryIO) -> list[Request]:
-    return [Request(**request) for request in yaml.safe_load(fp)]
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return [Request(**request) for request in yaml.load(fp, Loader=loader)]
 
 
 def dump_requests(requests: list[Request], fp: TextIO | BinaryIO) -> None:
+    import yaml
+
     yaml.safe_dump([request.model_dump() for request in requests], fp)
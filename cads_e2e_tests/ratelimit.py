@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import Any, ContextManager, MutableMapping
+
+import requests
+from requests.adapters import HTTPAdapter
+
+THROTTLING_STATUS_CODES = (429, 503)
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+def _retry_after(response: requests.Response) -> float | None:
+    retry_after = response.headers.get("Retry-After", "")
+    return float(retry_after) if retry_after.isdigit() else None
+
+
+class RateLimiter:
+    # The token bucket and the backoff deadline are kept in state. State and
+    # lock can be shared by processes (e.g. through a multiprocessing manager),
+    # so that worker processes pace and back off together.
+    def __init__(
+        self,
+        rate: float | None = None,
+        burst: int = 1,
+        backoff: float = BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+        state: MutableMapping[str, float] | None = None,
+        lock: ContextManager[Any] | None = None,
+    ) -> None:
+        assert rate is None or rate > 0
+        assert burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock() if lock is None else lock
+        self.state = {} if state is None else state
+        with self.lock:
+            if "tokens" not in self.state:
+                self.state.update(
+                    tokens=float(burst),
+                    updated_at=time.monotonic(),
+                    backoff_until=0.0,
+                    n_consecutive_throttles=0,
+                )
+        self.local = threading.local()
+
+    @property
+    def n_consecutive_throttles(self) -> int:
+        return int(self.state["n_consecutive_throttles"])
+
+    @property
+    def n_throttled(self) -> int:
+        # Counted per thread, so that each task reports its own throttle events
+        n_throttled: int = getattr(self.local, "n_throttled", 0)
+        return n_throttled
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                # One round trip to read and one to write shared states
+                state = dict(self.state.items())
+                now = time.monotonic()
+                wait = state["backoff_until"] - now
+                if self.rate is None:
+                    if wait <= 0:
+                        return
+                else:
+                    tokens = min(
+                        self.burst,
+                        state["tokens"] + (now - state["updated_at"]) * self.rate,
+                    )
+                    if wait <= 0:
+                        if tokens >= 1:
+                            self.state.update(tokens=tokens - 1, updated_at=now)
+                            return
+                        wait = (1 - tokens) / self.rate
+                    self.state.update(tokens=tokens, updated_at=now)
+            time.sleep(wait)
+
+    def throttle(self, retry_after: float | None = None) -> None:
+        with self.lock:
+            state = dict(self.state.items())
+            n_consecutive_throttles = state["n_consecutive_throttles"]
+            if retry_after is None:
+                retry_after = min(
+                    self.backoff * 2**n_consecutive_throttles, self.max_backoff
+                )
+            self.state.update(
+                n_consecutive_throttles=n_consecutive_throttles + 1,
+                backoff_until=max(
+                    state["backoff_until"], time.monotonic() + retry_after
+                ),
+            )
+        self.local.n_throttled = self.n_throttled + 1
+
+    def release(self) -> None:
+        with self.lock:
+            if self.state["n_consecutive_throttles"]:
+                self.state["n_consecutive_throttles"] = 0
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    def __init__(self, rate_limiter: RateLimiter, **kwargs: Any) -> None:
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(
+        self, request: requests.PreparedRequest, *args: Any, **kwargs: Any
+    ) -> requests.Response:
+        self.rate_limiter.acquire()
+        response = super().send(request, *args, **kwargs)
+        if response.status_code in THROTTLING_STATUS_CODES:
+            self.rate_limiter.throttle(_retry_after(response))
+        else:
+            self.rate_limiter.release()
+        return response
+
+
+_RATE_LIMITERS: dict[float | None, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+# State and lock shared with the other worker processes of a run
+_SHARED_STATE: tuple[MutableMapping[str, float], ContextManager[Any]] | None = None
+
+
+def share_rate_limiter_state(
+    shared_state: tuple[MutableMapping[str, float], ContextManager[Any]] | None,
+) -> None:
+    global _SHARED_STATE
+    with _RATE_LIMITERS_LOCK:
+        if shared_state is not _SHARED_STATE:
+            _RATE_LIMITERS.clear()
+        _SHARED_STATE = shared_state
+
+
+def get_rate_limiter(rate: float | None = None) -> RateLimiter:
+    # Rate limiters are shared by all clients and threads of a process, and by
+    # all processes sharing their state.
+    with _RATE_LIMITERS_LOCK:
+        if (rate_limiter := _RATE_LIMITERS.get(rate)) is None:
+            state, lock = (None, None) if _SHARED_STATE is None else _SHARED_STATE
+            rate_limiter = _RATE_LIMITERS[rate] = RateLimiter(
+                rate, state=state, lock=lock
+            )
+    return rate_limiter
@@ -1,16 +1,26 @@
 import collections
+import dataclasses
 import itertools
+import json
+import logging
 import random
 import re
-from typing import Any, Iterator, Sequence
-
-import joblib
+import statistics
+import time
+from typing import Any, Iterable, Iterator, Sequence
 
 from . import utils
-from .client import TestClient
-from .models import Checks, Report, Request
+from .client import (
+    LICENCES_CACHE_PATH,
+    accept_all_missing_licences,
+    get_test_client,
+)
+from .models import Checks, Report, Request, Settings
+from .scheduler import AdaptiveRepeats, CircuitBreaker, Scheduler
+
+LOGGER = logging.getLogger(__name__)
 
-DOWNLOAD_CHECKS = {"checksum", "extension", "size"}
+DOWNLOAD_CHECKS = {"checksum", "extension", "format", "size"}
 REQUESTS_DEFAULT = None
 
 
@@ -23,12 +33,89 @@ def _switch_off_download_checks(request: Request) -> Request:
     return Request(checks=checks, **request.model_dump(exclude={"checks"}))
 
 
+def _request_fingerprint(request: Request, cache_key: str | None) -> str:
+    parameters = {k: v for k, v in request.parameters.items() if k != cache_key}
+    return json.dumps([request.collection_id, parameters], sort_keys=True)
+
+
+@dataclasses.dataclass
+class DurationPredictor:
+    # Durations are the wall time of successful requests in previous reports,
+    # predicted per request fingerprint, then per collection. Unknown
+    # collections are assumed to be as slow as the slowest known one.
+    reports: Iterable[Report]
+    cache_key: str | None = None
+
+    def __post_init__(self) -> None:
+        durations: dict[str, list[float]] = collections.defaultdict(list)
+        collection_durations: dict[str, list[float]] = collections.defaultdict(list)
+        for report in self.reports:
+            if report.tracebacks:
+                continue
+            duration = (report.finished_at - report.started_at).total_seconds()
+            durations[_request_fingerprint(report.request, self.cache_key)].append(
+                duration
+            )
+            collection_durations[report.request.collection_id].append(duration)
+        self.durations = {k: statistics.median(v) for k, v in durations.items()}
+        self.collection_durations = {
+            k: statistics.median(v) for k, v in collection_durations.items()
+        }
+        self.default_duration = max(self.collection_durations.values(), default=0.0)
+
+    def predict(self, request: Request) -> float:
+        fingerprint = _request_fingerprint(request, self.cache_key)
+        if (duration := self.durations.get(fingerprint)) is None:
+            duration = self.collection_durations.get(
+                request.collection_id, self.default_duration
+            )
+        return duration
+
+
+def _clients_kwargs(
+    url: str | None,
+    keys: list[str],
+    backend: str,
+    n_jobs: int,
+    n_download_jobs: int | None,
+    max_request_rate: float | None,
+    **kwargs: Any,
+) -> list[dict[str, Any]]:
+    if kwargs.get("pool_maxsize") is None:
+        kwargs.pop("pool_maxsize", None)
+        if backend == "threading":
+            # Threads share one client per key, keep a connection for each of them
+            kwargs["pool_maxsize"] = n_jobs + (n_download_jobs or 0)
+    return [
+        dict(url=url, key=key, max_request_rate=max_request_rate, **kwargs)
+        for key in ([None] if not keys else keys)
+    ]
+
+
+def _seed_requests(requests: Iterable[Request], seed: int) -> Iterator[Request]:
+    # Each request gets its own random stream derived from the collection and the
+    # repeat index, so that workloads do not depend on n_jobs or completion order.
+    repeat_indices: collections.Counter[str] = collections.Counter()
+    for request in requests:
+        repeat_index = repeat_indices[request.collection_id]
+        repeat_indices[request.collection_id] += 1
+        if request.settings.seed is not None:
+            yield request
+            continue
+        settings = Settings(
+            seed=utils.derive_seed(seed, request.collection_id, repeat_index),
+            **request.settings.model_dump(exclude={"seed"}),
+        )
+        yield Request(settings=settings, **request.model_dump(exclude={"settings"}))
+
+
 def reports_generator(
     url: str | None,
     keys: list[str],
-    requests: Sequence[Request] | None = None,
+    requests: Iterable[Request] | None = None,
     cache_key: str | None = None,
     n_jobs: int = 1,
+    backend: str = "loky",
     verbose: int = 0,
     regex_pattern: str = "",
     download: bool = True,
@@ -41,16 +128,47 @@ def reports_generator(
     max_replication_lag: float = 1.0,
     get_elapsed_time: bool = True,
     working_dir: str | None = None,
+    n_download_jobs: int | None = None,
+    download_queue_size: int | None = None,
+    estimate_costs: bool = False,
+    max_cost: float | None = None,
+    measure_cache: bool = False,
+    max_request_rate: float | None = None,
+    max_queue_time: float | None = None,
+    max_total_time: float | None = None,
+    deadline: float | None = None,
+    cache_licences: bool = False,
+    seed: int | None = None,
+    n_requests: int | None = None,
+    max_in_flight: int | None = None,
+    max_in_flight_groups: dict[str, int] | None = None,
+    reports_history: Iterable[Report] | None = None,
+    breaker_failures: int | None = None,
+    breaker_failure_ratio: float | None = None,
+    breaker_window: int = 10,
+    breaker_probe_interval: float = 60.0,
+    max_relative_width: float | None = None,
+    latency_quantile: float = 0.5,
+    min_repeats: int = 3,
+    max_repeats: int = 30,
     **kwargs: Any,
 ) -> Iterator[Report]:
-    if requests and requests_pool:
+    run_deadline = None if deadline is None else time.time() + deadline
+    if requests is not None and requests_pool:
         raise ValueError("requests and requests_pool are mutually exclusive.")
+    if measure_cache and cache_key is None:
+        raise ValueError("measure_cache requires a cache_key.")
+    if max_relative_width is not None and n_repeats > 1:
+        # Copies in flight would overshoot max_repeats
+        raise ValueError("max_relative_width and n_repeats are mutually exclusive.")
 
-    clients = [
-        TestClient(url=url, key=key, **kwargs) for key in ([None] if not keys else keys)
-    ]
-    for client in clients:
-        client.accept_all_missing_licences()
+    clients_kwargs = _clients_kwargs(
+        url, keys, backend, n_jobs, n_download_jobs, max_request_rate, **kwargs
+    )
+    clients = [get_test_client(**client_kwargs) for client_kwargs in clients_kwargs]
+    accept_all_missing_licences(
+        clients, cache_path=LICENCES_CACHE_PATH if cache_licences else None
+    )
 
     if requests is None:
         requests_pool_defaultdict = collections.defaultdict(list)
@@ -58,44 +176,133 @@ def reports_generator(
             if not isinstance(request, Request):
                 request = Request(**request)
             requests_pool_defaultdict[request.collection_id].append(request)
-        requests = [
-            random.choice(
-                requests_pool_defaultdict[collection_id]
-                or [Request(collection_id=collection_id)]
-            )
+        collection_templates = [
+            requests_pool_defaultdict[collection_id]
+            or [Request(collection_id=collection_id)]
             for collection_id in clients[0].collection_ids
         ]
+        if n_requests is None:
+            # One random template per collection
+            requests = [
+                random.Random(
+                    None
+                    if seed is None
+                    else utils.derive_seed(seed, templates[0].collection_id)
+                ).choice(templates)
+                for templates in collection_templates
+            ]
+        else:
+            # All templates are sampled according to their weights
+            requests = list(itertools.chain.from_iterable(collection_templates))
 
-    requests = [
+    # Requests are streamed, so that large request files are never fully loaded
+    requests = (
         request
         for request in requests
         if re.search(regex_pattern, request.collection_id)
-    ]
+    )
 
     if not download:
-        requests = [_switch_off_download_checks(request) for request in requests]
+        requests = (_switch_off_download_checks(request) for request in requests)
 
-    requests = utils.reorder(
-        requests,
-        cyclic=cyclic,
-        randomise=randomise,
-        n_repeats=n_repeats,
-    )
+    if n_requests is None:
+        requests = utils.iter_reorder(
+            requests,
+            cyclic=cyclic,
+            randomise=randomise,
+            n_repeats=n_repeats,
+            rng=random.Random(seed),
+        )
+    else:
+        # Requests are sampled from the templates according to their weights
+        templates = list(requests)
+        requests = utils.iter_weighted_sample(
+            templates,
+            [template.settings.weight for template in templates],
+            n_requests,
+            rng=random.Random(seed),
+        )
+    if seed is not None:
+        requests = _seed_requests(requests, seed)
+    if reports_history is not None:
+        # Longest expected requests first, to minimise the total wall time
+        predictor = DurationPredictor(reports_history, cache_key=cache_key)
+        requests = sorted(requests, key=predictor.predict, reverse=True)
 
-    parallel = joblib.Parallel(
-        n_jobs=n_jobs, verbose=verbose, return_as="generator_unordered"
-    )
-    reports: Iterator[Report] = parallel(
-        client.delayed_make_report(
-            request=request,
-            cache_key=cache_key,
-            download=download,
-            max_runtime=max_runtime,
-            log_level=log_level,
-            max_replication_lag=max_replication_lag,
-            get_elapsed_time=get_elapsed_time,
-            working_dir=working_dir,
+    circuit_breaker = None
+    if breaker_failures is not None or breaker_failure_ratio is not None:
+        circuit_breaker = CircuitBreaker(
+            max_consecutive_failures=breaker_failures,
+            max_failure_ratio=breaker_failure_ratio,
+            window=breaker_window,
+            probe_interval=breaker_probe_interval,
         )
-        for client, request in zip(itertools.cycle(clients), requests)
+
+    adaptive_repeats = None
+    if max_relative_width is not None:
+        adaptive_repeats = AdaptiveRepeats(
+            max_relative_width=max_relative_width,
+            quantile=latency_quantile,
+            min_repeats=min_repeats,
+            max_repeats=max_repeats,
+        )
+
+    scheduler = Scheduler(
+        n_jobs=n_jobs,
+        backend=backend,
+        n_download_jobs=n_download_jobs,
+        download_queue_size=download_queue_size,
+        verbose=verbose,
+        log_level=log_level,
+        working_dir=working_dir,
+        run_deadline=run_deadline,
+        max_in_flight=max_in_flight,
+        max_in_flight_groups=max_in_flight_groups or {},
+        circuit_breaker=circuit_breaker,
+        adaptive_repeats=adaptive_repeats,
+        clients_kwargs=clients_kwargs,
     )
-    return reports
+    return scheduler.run(
+        zip(itertools.cycle(clients_kwargs), requests),
+        cache_key=cache_key,
+        download=download,
+        measure_cache=measure_cache,
+        max_runtime=max_runtime,
+        max_queue_time=max_queue_time,
+        max_total_time=max_total_time,
+        max_replication_lag=max_replication_lag,
+        get_elapsed_time=get_elapsed_time,
+        estimate_costs=estimate_costs,
+        max_cost=max_cost,
+    )
+
+
+def random_requests_generator(
+    url: str | None,
+    key: str | None,
+    requests: Iterable[Request] | None = None,
+    n_requests: int = 1,
+    regex_pattern: str = "",
+    batch_size: int = 1_000,
+    seed: int | None = None,
+    **kwargs: Any,
+) -> Iterator[Request]:
+    client = get_test_client(url=url, key=key, **kwargs)
+    if requests is None:
+        requests = [
+            Request(collection_id=collection_id)
+            for collection_id in client.collection_ids
+        ]
+
+    for index, request in enumerate(requests):
+        if not re.search(regex_pattern, request.collection_id):
+            continue
+        with utils.catch_exceptions([], logger=LOGGER):
+            for start in range(0, n_requests, batch_size):
+                size = min(batch_size, n_requests - start)
+                batch_seed = (
+                    None
+                    if seed is None
+                    else utils.derive_seed(seed, request.collection_id, index, start)
+                )
+                yield from client.random_requests(request, size, batch_seed)
@@ -0,0 +1,124 @@
+import collections
+import concurrent.futures
+import dataclasses
+import logging
+import threading
+import time
+from typing import Any
+
+from . import utils
+from .client import (
+    JOB_TIMES_FIELDS,
+    get_elapsed_time_from_json,
+    get_job_times,
+    get_test_client,
+)
+from .models import Report
+
+LOGGER = logging.getLogger(__name__)
+
+PendingReport = tuple[dict[str, Any], Report, float, concurrent.futures.Future[Report]]
+
+
+def _set_elapsed_time(report: Report, job: dict[str, Any]) -> Report:
+    elapsed_time = get_elapsed_time_from_json(job)
+    assert elapsed_time is not None
+    tracebacks = list(report.tracebacks)
+    with report.catch_exceptions(tracebacks):
+        report.request.checks.check_time(elapsed_time)
+    return Report(
+        time=elapsed_time,
+        tracebacks=tracebacks,
+        **get_job_times(job),
+        **report.model_dump(exclude={"time", "tracebacks", *JOB_TIMES_FIELDS}),
+    )
+
+
+def _set_replication_lag_error(report: Report) -> Report:
+    tracebacks = list(report.tracebacks)
+    with utils.catch_exceptions(tracebacks, logger=LOGGER):
+        raise TimeoutError("Maximum replication lag exceeded.")
+    return Report(
+        tracebacks=tracebacks,
+        **report.model_dump(exclude={"tracebacks"}),
+    )
+
+
+@dataclasses.dataclass
+class ElapsedTimeResolver:
+    # Reports whose job timestamps have not been replicated yet are resolved in
+    # the background, with one jobs listing call per client and poll.
+    max_replication_lag: float
+    poll_interval: float = 1.0
+
+    def __post_init__(self) -> None:
+        assert self.max_replication_lag >= 0
+        self.lock = threading.Lock()
+        self.pending: list[PendingReport] = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self, client_kwargs: dict[str, Any], report: Report
+    ) -> concurrent.futures.Future[Report]:
+        assert report.request_uid is not None
+        future: concurrent.futures.Future[Report] = concurrent.futures.Future()
+        deadline = time.monotonic() + self.max_replication_lag
+        with self.lock:
+            self.pending.append((client_kwargs, report, deadline, future))
+        return future
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                pending, self.pending = self.pending, []
+            unresolved = self.resolve(pending)
+            with self.lock:
+                self.pending.extend(unresolved)
+
+    def resolve(self, pending: list[PendingReport]) -> list[PendingReport]:
+        pending_by_client = collections.defaultdict(list)
+        for item in pending:
+            pending_by_client[tuple(sorted(item[0].items()))].append(item)
+
+        unresolved = []
+        for items in pending_by_client.values():
+            jobs: dict[str, dict[str, Any]] = {}
+            with utils.catch_exceptions([], logger=LOGGER):
+                client = get_test_client(**items[0][0])
+                jobs = client.get_jobs_by_id(
+                    *(
+                        report.request_uid
+                        for _, report, _, _ in items
+                        if report.request_uid
+                    )
+                )
+            for item in items:
+                _, report, deadline, future = item
+                assert report.request_uid is not None
+                job = jobs.get(report.request_uid, {})
+                tracebacks = list(report.tracebacks)
+                with utils.catch_exceptions(tracebacks, logger=LOGGER):
+                    if get_elapsed_time_from_json(job) is not None:
+                        future.set_result(_set_elapsed_time(report, job))
+                    elif time.monotonic() >= deadline:
+                        future.set_result(_set_replication_lag_error(report))
+                    else:
+                        unresolved.append(item)
+                    continue
+                # Jobs that cannot be parsed must not stop the resolver thread
+                future.set_result(
+                    Report(
+                        tracebacks=tracebacks,
+                        **report.model_dump(exclude={"tracebacks"}),
+                    )
+                )
+        return unresolved
+
+    def shutdown(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for _, _, _, future in pending:
+            future.cancel()
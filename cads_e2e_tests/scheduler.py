@@ -0,0 +1,782 @@
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import datetime
+import functools
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import signal
+import statistics
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Any, Callable, ContextManager, Iterable, Iterator, MutableMapping
+
+from joblib.externals.loky import get_reusable_executor
+
+from . import downloader, exceptions, ratelimit, utils
+from .client import (
+    cancel_live_requests,
+    cancel_shared_live_requests,
+    finalise_report,
+    get_test_client,
+    share_live_requests,
+)
+from .models import Report, Request, Settings
+from .resolver import ElapsedTimeResolver
+
+
+class SequentialExecutor(concurrent.futures.Executor):
+    def submit(
+        self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any
+    ) -> concurrent.futures.Future[Any]:
+        future: concurrent.futures.Future[Any] = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+def _raise_system_exit(signum: int, frame: FrameType | None) -> None:
+    raise SystemExit(128 + signum)
+
+
+@contextlib.contextmanager
+def exit_on_sigterm() -> Iterator[None]:
+    # SIGTERM unwinds the stack like SIGINT, so that live jobs are cancelled
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+SharedRateLimiterState = tuple[MutableMapping[str, float], ContextManager[Any]]
+
+
+@functools.cache
+def get_manager() -> Any:
+    # One manager per process, whose shared objects are cached so that the
+    # reusable executor keeps its workers
+    return multiprocessing.Manager()
+
+
+@functools.cache
+def get_shared_live_requests() -> MutableMapping[str, str]:
+    shared_live_requests: MutableMapping[str, str] = get_manager().dict()
+    return shared_live_requests
+
+
+@functools.cache
+def get_shared_rate_limiter_state() -> SharedRateLimiterState:
+    manager = get_manager()
+    return manager.dict(), manager.Lock()
+
+
+def initialize_worker(
+    log_level: str | None,
+    clients_kwargs: list[dict[str, Any]],
+    shared_live_requests: MutableMapping[str, str] | None = None,
+    shared_rate_limiter_state: SharedRateLimiterState | None = None,
+) -> None:
+    if log_level is not None:
+        logging.basicConfig(level=log_level.upper())
+    if multiprocessing.parent_process() is not None:
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+    share_live_requests(shared_live_requests)
+    ratelimit.share_rate_limiter_state(shared_rate_limiter_state)
+    for client_kwargs in clients_kwargs:
+        get_test_client(**client_kwargs)
+
+
+def download_report(
+    client_kwargs: dict[str, Any],
+    report: Report,
+    location: str,
+    working_dir: str | None,
+) -> Report:
+    client = get_test_client(**client_kwargs)
+    with utils.tmp_working_dir(working_dir) as tmpdir:
+        target = os.path.join(tmpdir, downloader.target_from_url(location))
+        report = client.download_report(report, location, target=target)
+    return finalise_report(report)
+
+
+def _warm_request(request: Request) -> Request:
+    # Replay the exact parameters of the cold request, including the cache key
+    settings = Settings(
+        randomise=False, **request.settings.model_dump(exclude={"randomise"})
+    )
+    return Request(settings=settings, **request.model_dump(exclude={"settings"}))
+
+
+def _repeat_request(request: Request, cache_key: str | None) -> Request:
+    # Repeat the exact parameters of the request, without the cache key so that
+    # the repeat stays cold
+    parameters = {k: v for k, v in request.parameters.items() if k != cache_key}
+    settings = Settings(
+        randomise=False, **request.settings.model_dump(exclude={"randomise"})
+    )
+    return Request(
+        parameters=parameters,
+        settings=settings,
+        **request.model_dump(exclude={"parameters", "settings"}),
+    )
+
+
+def make_report(
+    client_kwargs: dict[str, Any],
+    request: Request,
+    working_dir: str | None,
+    download: bool,
+    defer_download: bool,
+    **kwargs: Any,
+) -> tuple[Report, str | None]:
+    client = get_test_client(**client_kwargs)
+    try:
+        report, location = client.make_partial_report(request=request, **kwargs)
+    except (KeyboardInterrupt, SystemExit):
+        client.cancel_live_requests()
+        raise
+    if not download or location is None:
+        return finalise_report(report), None
+    if defer_download:
+        return report, location
+    return download_report(client_kwargs, report, location, working_dir), None
+
+
+def skipped_report(request: Request, reason: str) -> Report:
+    tracebacks: list[str] = []
+    with utils.catch_exceptions(tracebacks):
+        raise exceptions.CircuitOpenError(reason)
+    return Report(request=request, tracebacks=tracebacks, skipped=True)
+
+
+def deadline_report(request: Request) -> Report:
+    tracebacks: list[str] = []
+    with utils.catch_exceptions(tracebacks):
+        raise exceptions.DeadlineTimeoutError("Run deadline exceeded.")
+    return Report(
+        request=request,
+        tracebacks=tracebacks,
+        timeout=exceptions.DeadlineTimeoutError.limit,
+    )
+
+
+BACKENDS = ("loky", "threading")
+DEFERRED_TASKS_PER_JOB = 10
+
+Task = tuple[dict[str, Any], Request]
+
+
+@dataclasses.dataclass
+class InFlightLimiter:
+    # Tasks of collections at their cap are deferred, so that tasks of other
+    # collections can overtake them. Deferred tasks are released round-robin
+    # across groups, so that no collection starves.
+    max_in_flight: int | None = None
+    groups: dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        assert self.max_in_flight is None or self.max_in_flight >= 1
+        assert all(cap >= 1 for cap in self.groups.values())
+        self.in_flight: collections.Counter[str] = collections.Counter()
+        self.deferred: dict[str, collections.deque[Task]] = {}
+        self.n_deferred = 0
+        self._groups: dict[str, tuple[str, int | None]] = {}
+
+    def get_group(self, collection_id: str) -> tuple[str, int | None]:
+        if (group := self._groups.get(collection_id)) is None:
+            group = (collection_id, self.max_in_flight)
+            for pattern, cap in self.groups.items():
+                if re.search(pattern, collection_id):
+                    group = (pattern, cap)
+                    break
+            self._groups[collection_id] = group
+        return group
+
+    def is_full(self, collection_id: str) -> bool:
+        group, cap = self.get_group(collection_id)
+        return cap is not None and self.in_flight[group] >= cap
+
+    def acquire(self, collection_id: str) -> None:
+        self.in_flight[self.get_group(collection_id)[0]] += 1
+
+    def release(self, collection_id: str) -> None:
+        self.in_flight[self.get_group(collection_id)[0]] -= 1
+
+    def defer(self, task: Task) -> None:
+        group, _ = self.get_group(task[1].collection_id)
+        self.deferred.setdefault(group, collections.deque()).append(task)
+        self.n_deferred += 1
+
+    def pop_ready(self) -> Task | None:
+        for group, tasks in self.deferred.items():
+            if not self.is_full(tasks[0][1].collection_id):
+                task = tasks.popleft()
+                # Move the group to the back of the round-robin
+                del self.deferred[group]
+                if tasks:
+                    self.deferred[group] = tasks
+                self.n_deferred -= 1
+                return task
+        return None
+
+    def clear(self) -> None:
+        self.deferred.clear()
+        self.n_deferred = 0
+
+
+@dataclasses.dataclass
+class CircuitBreaker:
+    # The breaker of a collection opens after too many consecutive failures, or
+    # too high a failure ratio in the last window of requests. While open, one
+    # probe request is let through every probe_interval: a success closes the
+    # breaker, a failure keeps it open. Outcomes of other requests completing
+    # while the breaker is open are ignored.
+    max_consecutive_failures: int | None = None
+    max_failure_ratio: float | None = None
+    window: int = 10
+    probe_interval: float = 60.0
+
+    def __post_init__(self) -> None:
+        assert (
+            self.max_consecutive_failures is None or self.max_consecutive_failures >= 1
+        )
+        assert self.max_failure_ratio is None or 0 < self.max_failure_ratio <= 1
+        assert self.window >= 1
+        self.consecutive_failures: collections.Counter[str] = collections.Counter()
+        self.outcomes: dict[str, collections.deque[bool]] = {}
+        self.opened_at: dict[str, float] = {}
+        self.probing: set[str] = set()
+
+    def is_open(self, collection_id: str) -> bool:
+        return collection_id in self.opened_at
+
+    def allow(self, collection_id: str) -> bool:
+        if (opened_at := self.opened_at.get(collection_id)) is None:
+            return True
+        if (
+            collection_id in self.probing
+            or time.monotonic() - opened_at < self.probe_interval
+        ):
+            return False
+        self.probing.add(collection_id)
+        return True
+
+    def record(self, collection_id: str, failed: bool, probe: bool = False) -> None:
+        if self.is_open(collection_id):
+            if not probe:
+                return
+            if not failed:
+                self.close(collection_id)
+            else:
+                self.probing.discard(collection_id)
+                self.opened_at[collection_id] = time.monotonic()
+            return
+
+        outcomes = self.outcomes.setdefault(
+            collection_id, collections.deque(maxlen=self.window)
+        )
+        outcomes.append(failed)
+        if failed:
+            self.consecutive_failures[collection_id] += 1
+        else:
+            self.consecutive_failures[collection_id] = 0
+
+        if (
+            self.max_consecutive_failures is not None
+            and self.consecutive_failures[collection_id]
+            >= self.max_consecutive_failures
+        ) or (
+            self.max_failure_ratio is not None
+            and len(outcomes) == self.window
+            and sum(outcomes) / self.window >= self.max_failure_ratio
+        ):
+            self.opened_at[collection_id] = time.monotonic()
+
+    def close(self, collection_id: str) -> None:
+        self.opened_at.pop(collection_id, None)
+        self.probing.discard(collection_id)
+        self.outcomes.pop(collection_id, None)
+        self.consecutive_failures[collection_id] = 0
+
+
+def _request_key(request: Request) -> str:
+    return json.dumps(
+        [request.collection_id, request.parameters, request.settings.seed],
+        sort_keys=True,
+        default=str,
+    )
+
+
+@dataclasses.dataclass
+class AdaptiveRepeats:
+    # Requests are resubmitted until the distribution-free confidence interval of
+    # their latency quantile is narrower than max_relative_width, within
+    # min_repeats and max_repeats. Identical requests share their samples.
+    # Requests failing min_repeats times in a row are given up, so that broken
+    # collections are not loaded any further.
+    max_relative_width: float = 0.1
+    quantile: float = 0.5
+    confidence: float = 0.95
+    min_repeats: int = 3
+    max_repeats: int = 30
+
+    def __post_init__(self) -> None:
+        assert self.max_relative_width > 0
+        assert 0 < self.quantile < 1
+        assert 0 < self.confidence < 1
+        assert 1 <= self.min_repeats <= self.max_repeats
+        self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+        self.n_repeats: collections.Counter[str] = collections.Counter()
+        self.consecutive_failures: collections.Counter[str] = collections.Counter()
+
+    def relative_width(self, latencies: list[float]) -> float:
+        # Order statistics bounding the quantile, from the normal approximation
+        # of the binomial distribution
+        size = len(latencies)
+        if not size:
+            return math.inf
+        z = statistics.NormalDist().inv_cdf((1 + self.confidence) / 2)
+        half_width = z * math.sqrt(size * self.quantile * (1 - self.quantile))
+        lower = max(math.floor(size * self.quantile - half_width), 0)
+        upper = min(math.ceil(size * self.quantile + half_width), size - 1)
+        latencies = sorted(latencies)
+        estimate = latencies[min(int(size * self.quantile), size - 1)]
+        if estimate <= 0:
+            return math.inf
+        return (latencies[upper] - latencies[lower]) / estimate
+
+    def record(self, request: Request, latency: float | None) -> bool:
+        # Returns whether the request should be resubmitted
+        key = _request_key(request)
+        self.n_repeats[key] += 1
+        if latency is None:
+            self.consecutive_failures[key] += 1
+            if self.consecutive_failures[key] >= self.min_repeats:
+                return False
+        else:
+            self.consecutive_failures[key] = 0
+            self.latencies[key].append(latency)
+        if self.n_repeats[key] >= self.max_repeats:
+            return False
+        # Failures count towards max_repeats, but not towards min_repeats
+        if len(self.latencies[key]) < self.min_repeats:
+            return True
+        return self.relative_width(self.latencies[key]) > self.max_relative_width
+
+
+@dataclasses.dataclass
+class Submission:
+    client_kwargs: dict[str, Any]
+    request: Request
+    # The cold report of warm replays
+    cold_report: Report | None = None
+    # Whether the request probes an open circuit breaker
+    probe: bool = False
+
+
+@dataclasses.dataclass
+class TaskSelector:
+    # Picks the next request to submit, by priority: warm replays of cold
+    # requests, deferred tasks whose group has room, adaptive repeats, then new
+    # tasks. Tasks with a submit_at setting are held back until that offset from
+    # the start of the run. Tasks of groups at their cap are deferred.
+    tasks: Iterator[Task]
+    limiter: InFlightLimiter
+    max_deferred: int
+    run_deadline: float | None = None
+
+    def __post_init__(self) -> None:
+        self.started = time.monotonic()
+        self.pending: Task | None = None
+        self.replays: collections.deque[tuple[dict[str, Any], Report]]
+        self.replays = collections.deque()
+        self.repeats: collections.deque[Task] = collections.deque()
+        self.exhausted = False
+
+    def has_tasks(self) -> bool:
+        return bool(
+            self.replays
+            or self.repeats
+            or self.limiter.n_deferred
+            or not self.exhausted
+        )
+
+    def due_in(self) -> float | None:
+        # Seconds until the pending task is due, if it is held back
+        if self.pending is None:
+            return None
+        if (submit_at := self.pending[1].settings.submit_at) is None:
+            return None
+        timeout = self.started + submit_at - time.monotonic()
+        if self.run_deadline is not None:
+            # Wake up in time to drop the task at the deadline
+            timeout = min(timeout, self.run_deadline - time.time())
+        return timeout if timeout > 0 else None
+
+    def select(self) -> Submission | None:
+        while True:
+            # Replays of groups at their cap wait in the queue
+            for index, (client_kwargs, cold_report) in enumerate(self.replays):
+                if not self.limiter.is_full(cold_report.request.collection_id):
+                    del self.replays[index]
+                    request = _warm_request(cold_report.request)
+                    return Submission(client_kwargs, request, cold_report)
+            if (deferred_task := self.limiter.pop_ready()) is not None:
+                return Submission(*deferred_task)
+
+            if self.pending is None and self.repeats:
+                self.pending = self.repeats.popleft()
+            elif self.exhausted or self.limiter.n_deferred >= self.max_deferred:
+                return None
+            if self.pending is None:
+                try:
+                    self.pending = next(self.tasks)
+                except StopIteration:
+                    self.exhausted = True
+                    return None
+            if self.due_in() is not None:
+                return None
+            task, self.pending = self.pending, None
+            if self.limiter.is_full(task[1].collection_id):
+                self.limiter.defer(task)
+                continue
+            return Submission(*task)
+
+    def drop(self) -> Iterator[Submission]:
+        # Tasks not submitted yet are dropped, including those not read yet
+        dropped = [
+            Submission(client_kwargs, _warm_request(cold_report.request), cold_report)
+            for client_kwargs, cold_report in self.replays
+        ]
+        for task in itertools.chain(
+            [] if self.pending is None else [self.pending],
+            self.repeats,
+            *self.limiter.deferred.values(),
+        ):
+            dropped.append(Submission(*task))
+        tasks: Iterable[Task] = [] if self.exhausted else self.tasks
+        self.exhausted = True
+        self.pending = None
+        self.replays.clear()
+        self.repeats.clear()
+        self.limiter.clear()
+        return itertools.chain(dropped, (Submission(*task) for task in tasks))
+
+
+@dataclasses.dataclass
+class Scheduler:
+    n_jobs: int = 1
+    backend: str = "loky"
+    n_download_jobs: int | None = None
+    download_queue_size: int | None = None
+    verbose: int = 0
+    log_level: str | None = None
+    working_dir: str | None = None
+    run_deadline: float | None = None
+    max_in_flight: int | None = None
+    max_in_flight_groups: dict[str, int] = dataclasses.field(default_factory=dict)
+    circuit_breaker: CircuitBreaker | None = None
+    adaptive_repeats: AdaptiveRepeats | None = None
+    clients_kwargs: list[dict[str, Any]] = dataclasses.field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        assert self.n_jobs >= 1
+        assert self.backend in BACKENDS
+        assert self.n_download_jobs is None or self.n_download_jobs >= 1
+        self.n_completed = 0
+        self.n_cancelled = 0
+        self.n_skipped = 0
+        self.shared_live_requests: MutableMapping[str, str] | None = None
+        self.tic = time.perf_counter()
+
+    def get_executor(self) -> concurrent.futures.Executor:
+        initargs = (self.log_level, self.clients_kwargs)
+        if self.n_jobs == 1:
+            initialize_worker(*initargs)
+            return SequentialExecutor()
+        if self.backend == "threading":
+            return concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.n_jobs,
+                initializer=initialize_worker,
+                initargs=initargs,
+            )
+        # Jobs live in the worker processes, they are shared with this process so
+        # that it can delete them when the run is interrupted. Workers share one
+        # rate limiter, so that they pace and back off together.
+        self.shared_live_requests = get_shared_live_requests()
+        executor: concurrent.futures.Executor
+        executor = get_reusable_executor(
+            max_workers=self.n_jobs,
+            initializer=initialize_worker,
+            initargs=(
+                *initargs,
+                self.shared_live_requests,
+                get_shared_rate_limiter_state(),
+            ),
+        )
+        return executor
+
+    def echo_progress(self) -> None:
+        self.n_completed += 1
+        if self.verbose:
+            elapsed = time.perf_counter() - self.tic
+            print(
+                f"[{type(self).__name__}(n_jobs={self.n_jobs}, backend={self.backend})]: "
+                f"Done {self.n_completed:4d} tasks | elapsed: {elapsed:6.1f}s",
+                file=sys.stderr,
+            )
+
+    def cancel_live_requests(self) -> None:
+        n_cancelled = cancel_live_requests()
+        if self.shared_live_requests is not None:
+            clients = [
+                get_test_client(**client_kwargs)
+                for client_kwargs in self.clients_kwargs
+            ]
+            n_cancelled += cancel_shared_live_requests(
+                clients, self.shared_live_requests
+            )
+        if n_cancelled:
+            self.n_cancelled += n_cancelled
+            print(
+                f"[{type(self).__name__}]: Cancelled {n_cancelled} live jobs",
+                file=sys.stderr,
+            )
+
+    def run(
+        self,
+        tasks: Iterable[tuple[dict[str, Any], Request]],
+        download: bool,
+        measure_cache: bool = False,
+        **kwargs: Any,
+    ) -> Iterator[Report]:
+        # Jobs still running in this process or its workers are deleted from the
+        # server when the run is interrupted or the generator is closed.
+        with exit_on_sigterm():
+            try:
+                yield from self._run(tasks, download, measure_cache, **kwargs)
+            finally:
+                self.cancel_live_requests()
+
+    def _allow(self, submission: Submission) -> bool:
+        # Requests of collections whose circuit breaker is open are skipped, warm
+        # replays are always let through.
+        if submission.cold_report is not None or self.circuit_breaker is None:
+            return True
+        collection_id = submission.request.collection_id
+        if not self.circuit_breaker.allow(collection_id):
+            return False
+        submission.probe = self.circuit_breaker.is_open(collection_id)
+        return True
+
+    def _record_outcome(self, submission: Submission, report: Report) -> None:
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(
+                report.request.collection_id,
+                bool(report.tracebacks),
+                probe=submission.probe,
+            )
+
+    def _repeat(
+        self,
+        selector: TaskSelector,
+        submission: Submission,
+        report: Report,
+        cache_key: str | None,
+    ) -> None:
+        # With adaptive_repeats, completed requests are resubmitted until their
+        # latency estimate converges. Repeats reuse the submitted parameters, so
+        # that randomised requests are not merged with new draws.
+        if self.adaptive_repeats is None or submission.cold_report is not None:
+            return
+        request = report.request
+        if request != submission.request:
+            request = _repeat_request(request, cache_key)
+        if self.adaptive_repeats.record(request, report.latency):
+            selector.repeats.append((submission.client_kwargs, request))
+
+    def _add_submit_offset(
+        self, report: Report, started_at: datetime.datetime
+    ) -> Report:
+        if report.request.settings.submit_at is None:
+            return report
+        submit_offset = report.started_at - started_at
+        return Report(
+            submit_offset=submit_offset.total_seconds(),
+            **report.model_dump(exclude={"submit_offset"}),
+        )
+
+    def _pair_cache(
+        self, selector: TaskSelector, submission: Submission, report: Report
+    ) -> Report:
+        # Each successful cold request is replayed as soon as it completes, so
+        # that the warm request hits the cache.
+        cold_report = submission.cold_report
+        report = Report(
+            cache="cold" if cold_report is None else "warm",
+            paired_request_uid=None if cold_report is None else cold_report.request_uid,
+            **report.model_dump(exclude={"cache", "paired_request_uid"}),
+        )
+        if cold_report is None and not report.tracebacks:
+            selector.replays.append((submission.client_kwargs, report))
+        return report
+
+    def _run(
+        self,
+        tasks: Iterable[tuple[dict[str, Any], Request]],
+        download: bool,
+        measure_cache: bool,
+        **kwargs: Any,
+    ) -> Iterator[Report]:
+        # When n_download_jobs is set, requests are submitted and polled by n_jobs
+        # workers, then handed over to the download threads through a bounded queue.
+        # Elapsed times not replicated yet are resolved in the background, so that
+        # workers do not wait for the replication lag.
+        # The order of submissions is left to the TaskSelector, each other feature
+        # hooks into the submission or the completion of requests.
+        started_at = datetime.datetime.now()
+        limiter = InFlightLimiter(self.max_in_flight, self.max_in_flight_groups)
+        selector = TaskSelector(
+            iter(tasks),
+            limiter,
+            max_deferred=DEFERRED_TASKS_PER_JOB * self.n_jobs,
+            run_deadline=self.run_deadline,
+        )
+        resolver = None
+        if kwargs.get("get_elapsed_time"):
+            resolver = ElapsedTimeResolver(kwargs["max_replication_lag"])
+            kwargs = kwargs | {"defer_elapsed_time": True}
+        defer_download = download and self.n_download_jobs is not None
+        n_download_jobs = self.n_download_jobs or 1
+        queue_size = self.download_queue_size or 2 * n_download_jobs
+
+        executor = self.get_executor()
+        download_executor = concurrent.futures.ThreadPoolExecutor(n_download_jobs)
+        running: dict[concurrent.futures.Future[tuple[Report, str | None]], Submission]
+        running = {}
+        downloading: dict[concurrent.futures.Future[Report], Submission] = {}
+        resolving: set[concurrent.futures.Future[Report]] = set()
+        download_queue: collections.deque[tuple[Submission, Report, str]]
+        download_queue = collections.deque()
+        try:
+            while True:
+                if self.run_deadline is not None and time.time() > self.run_deadline:
+                    for dropped in selector.drop():
+                        report = deadline_report(dropped.request)
+                        if measure_cache:
+                            report = self._pair_cache(selector, dropped, report)
+                        self.echo_progress()
+                        yield report
+                while (
+                    selector.has_tasks()
+                    and len(running) < self.n_jobs
+                    and len(download_queue) < queue_size
+                ):
+                    if (submission := selector.select()) is None:
+                        break
+                    if not self._allow(submission):
+                        self.n_skipped += 1
+                        self.echo_progress()
+                        yield skipped_report(
+                            submission.request, "Circuit breaker open."
+                        )
+                        continue
+                    task_kwargs = kwargs
+                    if submission.cold_report is not None:
+                        task_kwargs = kwargs | {"cache_key": None}
+                    limiter.acquire(submission.request.collection_id)
+                    future = executor.submit(
+                        make_report,
+                        submission.client_kwargs,
+                        submission.request,
+                        working_dir=self.working_dir,
+                        download=download,
+                        defer_download=defer_download,
+                        run_deadline=self.run_deadline,
+                        **task_kwargs,
+                    )
+                    running[future] = submission
+
+                while download_queue and len(downloading) < n_download_jobs:
+                    submission, report, download_location = download_queue.popleft()
+                    download_future = download_executor.submit(
+                        download_report,
+                        submission.client_kwargs,
+                        report,
+                        download_location,
+                        working_dir=self.working_dir,
+                    )
+                    downloading[download_future] = submission
+
+                timeout = selector.due_in()
+                if not (running or downloading or resolving):
+                    if selector.pending is None:
+                        break
+                    time.sleep(timeout or 0)
+                    continue
+
+                futures: list[concurrent.futures.Future[Any]]
+                futures = [*running, *downloading, *resolving]
+                done, _ = concurrent.futures.wait(
+                    futures,
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                completed: list[tuple[Submission, Report]] = []
+                for done_future in done:
+                    if done_future in resolving:
+                        resolving.remove(done_future)
+                        self.echo_progress()
+                        yield done_future.result()
+                        continue
+
+                    if done_future in downloading:
+                        submission = downloading.pop(done_future)
+                        completed.append((submission, done_future.result()))
+                        continue
+
+                    submission = running.pop(done_future)
+                    report, location = done_future.result()
+                    limiter.release(submission.request.collection_id)
+                    self._repeat(selector, submission, report, kwargs.get("cache_key"))
+                    report = self._add_submit_offset(report, started_at)
+                    if measure_cache:
+                        report = self._pair_cache(selector, submission, report)
+                    if location is None:
+                        completed.append((submission, report))
+                    else:
+                        download_queue.append((submission, report, location))
+
+                for submission, report in completed:
+                    self._record_outcome(submission, report)
+                    if (
+                        resolver is not None
+                        and report.latency is not None
+                        and report.time is None
+                    ):
+                        resolving.add(resolver.submit(submission.client_kwargs, report))
+                    else:
+                        self.echo_progress()
+                        yield report
+        finally:
+            if resolver is not None:
+                resolver.shutdown()
+            for pending_future in running:
+                pending_future.cancel()
+            if isinstance(executor, concurrent.futures.ThreadPoolExecutor):
+                executor.shutdown(wait=False, cancel_futures=True)
+            download_executor.shutdown(wait=False, cancel_futures=True)
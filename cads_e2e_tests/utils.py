@@ -2,13 +2,17 @@ import contextlib
 import dataclasses
 import datetime
 import hashlib
+import json
 import logging
 import os
 import random
 import tempfile
 import traceback
 from abc import ABC, abstractmethod
-from typing import Any, Iterator, Literal, Type
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Literal, Type
+
+if TYPE_CHECKING:
+    import numpy as np
 
 DEFAULT_GEOGRAPHIC_LOCATION_DETAILS: dict[str, float] = {
     "minY": -90.0,
@@ -24,6 +28,20 @@ DEFAULT_GEOGRAPHIC_EXTENT_DETAILS: dict[str, Any] = {
     "maximum_extent": {"lat": 180, "lon": 360},
 }
 
+WidgetType = Literal[
+    "StringChoiceWidget",
+    "StringListWidget",
+    "GeographicLocationWidget",
+    "FreeformInputWidget",
+    "DateRangeWidget",
+    "StringListArrayWidget",
+    "GeographicExtentWidget",
+]
+VECTORISED_WIDGETS = [
+    "DateRangeWidget",
+    "GeographicExtentWidget",
+    "GeographicLocationWidget",
+]
 LIST_WIDGETS = [
     "DateRangeWidget",
     "StringListArrayWidget",
@@ -34,13 +52,12 @@ LIST_WIDGETS = [
 
 @contextlib.contextmanager
 def tmp_working_dir(dir: str | None) -> Iterator[str]:
-    old_dir = os.getcwd()
+    # The process working directory is left untouched, so that concurrent tasks
+    # running in threads do not interfere with each other.
+    if dir is not None:
+        dir = os.path.abspath(dir)
     with tempfile.TemporaryDirectory(dir=dir) as tmpdir:
-        os.chdir(tmpdir)
-        try:
-            yield tmpdir
-        finally:
-            os.chdir(old_dir)
+        yield tmpdir
 
 
 @contextlib.contextmanager
@@ -77,10 +94,17 @@ class TargetInfo:
         return os.path.getsize(self.target)
 
 
-def random_date(start: str, end: str) -> str:
+def derive_seed(*keys: Any) -> int:
+    # Stable across processes and python versions, unlike hash()
+    digest = hashlib.sha256(json.dumps(keys).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def random_date(start: str, end: str, rng: random.Random | None = None) -> str:
+    rng = random.Random() if rng is None else rng
     start_date = datetime.date.fromisoformat(start)
     end_date = datetime.date.fromisoformat(end)
-    days = random.randint(0, (end_date - start_date).days)
+    days = rng.randint(0, (end_date - start_date).days)
     random_date = start_date + datetime.timedelta(days=days)
     return random_date.isoformat()
 
@@ -90,26 +114,85 @@ def reorder(
     cyclic: bool,
     randomise: bool,
     n_repeats: int,
+    rng: random.Random | None = None,
 ) -> list[Any]:
+    return list(iter_reorder(requests, cyclic, randomise, n_repeats, rng))
+
+
+def iter_reorder(
+    requests: Iterable[Any],
+    cyclic: bool,
+    randomise: bool,
+    n_repeats: int,
+    rng: random.Random | None = None,
+) -> Iterator[Any]:
+    # Requests are only loaded in memory when they need to be shuffled or cycled
+    if randomise or (cyclic and n_repeats > 1):
+        requests = list(requests)
+        if randomise:
+            (random.Random() if rng is None else rng).shuffle(requests)
+
     if cyclic:
-        output = []
         for _ in range(n_repeats):
-            output.extend(
-                random.sample(requests, len(requests)) if randomise else requests
-            )
-        return output
+            yield from requests
+        return
+
+    for request in requests:
+        for _ in range(n_repeats):
+            yield request
+
 
-    return [
-        request
-        for request in (
-            random.sample(requests, len(requests)) if randomise else requests
+@dataclasses.dataclass
+class AliasSampler:
+    # Walker's alias method: O(n) setup, then O(1) per sample
+    weights: list[float]
+
+    def __post_init__(self) -> None:
+        size = len(self.weights)
+        total = sum(self.weights)
+        if not size or total <= 0 or min(self.weights) < 0:
+            raise ValueError("weights must be non-negative with a positive sum.")
+
+        scaled = [weight * size / total for weight in self.weights]
+        self.probabilities = [1.0] * size
+        self.aliases = list(range(size))
+        small = [index for index, value in enumerate(scaled) if value < 1]
+        large = [index for index, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            small_index = small.pop()
+            large_index = large.pop()
+            self.probabilities[small_index] = scaled[small_index]
+            self.aliases[small_index] = large_index
+            scaled[large_index] -= 1 - scaled[small_index]
+            (small if scaled[large_index] < 1 else large).append(large_index)
+
+    def sample(self, rng: random.Random) -> int:
+        index = rng.randrange(len(self.weights))
+        return (
+            index if rng.random() < self.probabilities[index] else self.aliases[index]
         )
-        for _ in range(n_repeats)
-    ]
 
 
-def random_choice_from_range(start: float, stop: float, step: float = 1.0) -> float:
-    return round(random.uniform(start, stop) / step) * step
+def iter_weighted_sample(
+    items: list[Any],
+    weights: list[float],
+    size: int,
+    rng: random.Random | None = None,
+) -> Iterator[Any]:
+    if not size or not items or not sum(weights):
+        # Nothing to sample, e.g. no templates matched or all weights are 0
+        return
+    rng = random.Random() if rng is None else rng
+    sampler = AliasSampler(weights)
+    for _ in range(size):
+        yield items[sampler.sample(rng)]
+
+
+def random_choice_from_range(
+    start: float, stop: float, step: float = 1.0, rng: random.Random | None = None
+) -> float:
+    rng = random.Random() if rng is None else rng
+    return round(rng.uniform(start, stop) / step) * step
 
 
 def random_range_from_range(
@@ -118,36 +201,99 @@ def random_range_from_range(
     step: float = 1.0,
     min_extent: float = 0,
     max_extent: float | None = None,
+    rng: random.Random | None = None,
 ) -> tuple[float, float]:
     assert min_extent >= 0
     assert (stop - start) >= min_extent
-    start = random_choice_from_range(start, stop - min_extent, step)
+    rng = random.Random() if rng is None else rng
+    start = random_choice_from_range(start, stop - min_extent, step, rng)
     if max_extent is not None:
         stop = min(stop, start + max_extent)
-    stop = random_choice_from_range(start + min_extent, stop, step)
+    stop = random_choice_from_range(start + min_extent, stop, step, rng)
     return start, stop
 
 
+def random_dates(
+    start: str, end: str, size: int, rng: "np.random.Generator | None" = None
+) -> list[str]:
+    import numpy as np
+
+    rng = np.random.default_rng() if rng is None else rng
+    start_date = np.datetime64(start, "D")
+    days = (np.datetime64(end, "D") - start_date).astype(int)
+    dates = start_date + rng.integers(0, days, size, endpoint=True)
+    return [str(date) for date in dates]
+
+
+def random_choices_from_range(
+    start: float,
+    stop: "float | np.ndarray",
+    step: float = 1.0,
+    size: int = 1,
+    rng: "np.random.Generator | None" = None,
+) -> "np.ndarray":
+    import numpy as np
+
+    rng = np.random.default_rng() if rng is None else rng
+    return np.round(rng.uniform(start, stop, size) / step) * step
+
+
+def random_ranges_from_range(
+    start: float,
+    stop: float,
+    step: float = 1.0,
+    min_extent: float = 0,
+    max_extent: float | None = None,
+    size: int = 1,
+    rng: "np.random.Generator | None" = None,
+) -> "tuple[np.ndarray, np.ndarray]":
+    import numpy as np
+
+    assert min_extent >= 0
+    assert (stop - start) >= min_extent
+    rng = np.random.default_rng() if rng is None else rng
+    starts = random_choices_from_range(start, stop - min_extent, step, size, rng)
+    stops = np.full(size, stop, dtype=float)
+    if max_extent is not None:
+        stops = np.minimum(stops, starts + max_extent)
+    stops = np.round(rng.uniform(starts + min_extent, stops) / step) * step
+    return starts, stops
+
+
+def normalise_widget_details(
+    widget_type: WidgetType, details: dict[str, Any]
+) -> dict[str, Any]:
+    match widget_type:
+        case "GeographicLocationWidget":
+            return DEFAULT_GEOGRAPHIC_LOCATION_DETAILS | details
+        case "GeographicExtentWidget":
+            details = DEFAULT_GEOGRAPHIC_EXTENT_DETAILS | details
+            step = 10 ** (-details["precision"])
+            details.setdefault("stepX", step)
+            details.setdefault("stepY", step)
+            details.setdefault(
+                "minimum_extent", {"lat": details["stepY"], "lon": details["stepX"]}
+            )
+    return details
+
+
 def widget_random_selection(
-    widget_type: Literal[
-        "StringChoiceWidget",
-        "StringListWidget",
-        "GeographicLocationWidget",
-        "FreeformInputWidget",
-        "DateRangeWidget",
-        "StringListArrayWidget",
-        "GeographicExtentWidget",
-    ],
+    widget_type: WidgetType,
+    rng: random.Random | None = None,
     **details: Any,
 ) -> Any:
+    rng = random.Random() if rng is None else rng
+    details = normalise_widget_details(widget_type, details)
     match widget_type:
         case "StringChoiceWidget" | "StringListWidget":
-            return random.choice(details["values"])
+            return rng.choice(details["values"])
         case "GeographicLocationWidget":
-            details = DEFAULT_GEOGRAPHIC_LOCATION_DETAILS | details
             return {
                 coord: random_choice_from_range(
-                    *[details[f"{prefix}{suffix}"] for prefix in ("min", "max", "step")]
+                    details[f"min{suffix}"],
+                    details[f"max{suffix}"],
+                    details[f"step{suffix}"],
+                    rng,
                 )
                 for coord, suffix in zip(["latitude", "longitude"], ["Y", "X"])
             }
@@ -162,38 +308,97 @@ def widget_random_selection(
                         value = ""
             return value
         case "DateRangeWidget":
-            return "/".join([random_date(details["minStart"], details["maxEnd"])] * 2)
+            date = random_date(details["minStart"], details["maxEnd"], rng)
+            return "/".join([date] * 2)
         case "StringListArrayWidget":
             values = []
             for group in details["groups"]:
                 values.extend(group["values"])
-            return random.choice(values)
+            return rng.choice(values)
         case "GeographicExtentWidget":
-            details = DEFAULT_GEOGRAPHIC_EXTENT_DETAILS | details
-            step = 10 ** (-details["precision"])
-            step_x = details.get("stepX", step)
-            step_y = details.get("stepY", step)
-            details.setdefault("minimum_extent", {"lat": step_y, "lon": step_x})
-
             west, east = random_range_from_range(
                 details["range"]["w"],
                 details["range"]["e"],
-                step_x,
+                details["stepX"],
                 details["minimum_extent"]["lon"],
                 details["maximum_extent"]["lon"],
+                rng,
             )
             south, north = random_range_from_range(
                 details["range"]["s"],
                 details["range"]["n"],
-                step_y,
+                details["stepY"],
                 details["minimum_extent"]["lat"],
                 details["maximum_extent"]["lat"],
+                rng,
             )
             return [north, west, south, east]
         case _:
             raise NotImplementedError(f"{widget_type=}")
 
 
+def widget_random_selections(
+    widget_type: WidgetType,
+    size: int,
+    rng: "np.random.Generator | None" = None,
+    **details: Any,
+) -> list[Any]:
+    import numpy as np
+
+    details = normalise_widget_details(widget_type, details)
+    match widget_type:
+        case "GeographicLocationWidget":
+            latitudes, longitudes = (
+                random_choices_from_range(
+                    details[f"min{suffix}"],
+                    details[f"max{suffix}"],
+                    details[f"step{suffix}"],
+                    size=size,
+                    rng=rng,
+                ).tolist()
+                for suffix in ("Y", "X")
+            )
+            return [
+                {"latitude": latitude, "longitude": longitude}
+                for latitude, longitude in zip(latitudes, longitudes)
+            ]
+        case "DateRangeWidget":
+            dates = random_dates(details["minStart"], details["maxEnd"], size, rng)
+            return ["/".join([date] * 2) for date in dates]
+        case "GeographicExtentWidget":
+            wests, easts = random_ranges_from_range(
+                details["range"]["w"],
+                details["range"]["e"],
+                details["stepX"],
+                details["minimum_extent"]["lon"],
+                details["maximum_extent"]["lon"],
+                size=size,
+                rng=rng,
+            )
+            souths, norths = random_ranges_from_range(
+                details["range"]["s"],
+                details["range"]["n"],
+                details["stepY"],
+                details["minimum_extent"]["lat"],
+                details["maximum_extent"]["lat"],
+                size=size,
+                rng=rng,
+            )
+            extents: list[Any] = np.stack(
+                [norths, wests, souths, easts], axis=1
+            ).tolist()
+            return extents
+        case _:
+            # Fall back to scalar selections, drawn from the same random stream
+            scalar_rng = random.Random(
+                None if rng is None else int(rng.integers(2**63))
+            )
+            return [
+                widget_random_selection(widget_type, scalar_rng, **details)
+                for _ in range(size)
+            ]
+
+
 def ensure_list(value: Any) -> list[Any]:
     if isinstance(value, list):
         return value
@@ -214,7 +419,14 @@ class AbstractCollectionUtils(ABC):
     def apply_constraints(self, parameters: dict[str, Any]) -> dict[str, Any]:
         pass
 
-    def random_parameters(self, parameters: dict[str, Any]) -> dict[str, Any]:
+    def random_parameters(
+        self,
+        parameters: dict[str, Any],
+        selections: dict[str, Iterator[Any]] | None = None,
+        rng: random.Random | None = None,
+    ) -> dict[str, Any]:
+        selections = {} if selections is None else selections
+        rng = random.Random() if rng is None else rng
         forms = {
             form["name"]: {k: v for k, v in form.items() if k != "name"}
             for form in self.form
@@ -225,18 +437,20 @@ class AbstractCollectionUtils(ABC):
         original_keys = list(parameters)
         parameters = {k: ensure_list(v) for k, v in parameters.items()}
         parameters = self.apply_constraints(parameters) | parameters
-        added_keys = list(set(parameters) - set(original_keys))
-        random.shuffle(added_keys)
+        added_keys = sorted(set(parameters) - set(original_keys))
+        rng.shuffle(added_keys)
 
         # Random selection based on constraints
         names = original_keys + added_keys
         for name in names:
             if value := parameters[name]:
-                parameters[name] = random.choice(value)
+                parameters[name] = rng.choice(value)
             for k, v in self.apply_constraints(parameters).items():
                 if names.index(k) > names.index(name) or v == []:
                     if k in original_keys:
-                        v = list(set(v) & set(parameters[k]))
+                        # Keep the order of the constraints, for reproducibility
+                        allowed = set(parameters[k])
+                        v = [x for x in v if x in allowed]
                     parameters[k] = v
 
         # Choose widgets to process
@@ -244,7 +458,7 @@ class AbstractCollectionUtils(ABC):
             if widget["type"] == "GeographicExtentWidget" and not parameters.get(name):
                 parameters.pop(name, None)
         widgets_to_add = {
-            random.choice(form["children"])
+            rng.choice(form["children"])
             for form in forms.values()
             if form["type"] == "ExclusiveGroupAccordionWidget"
             and not set(form["children"]) & set(parameters)
@@ -264,18 +478,42 @@ class AbstractCollectionUtils(ABC):
                         # Select one day
                         start = date.split("/")[0]
                         end = date.split("/")[-1]
-                        parameters[name] = "/".join([random_date(start, end)] * 2)
+                        parameters[name] = "/".join([random_date(start, end, rng)] * 2)
 
         # Process widgets
         for name, widget in forms.items():
             if name in widgets_to_skip:
                 continue
-            parameters[name] = widget_random_selection(
-                widget["type"], **widget.get("details", {})
-            )
+            if name in selections:
+                parameters[name] = next(selections[name])
+            else:
+                parameters[name] = widget_random_selection(
+                    widget["type"], rng, **widget.get("details", {})
+                )
 
         return {
             name: ensure_list(value) if widget.get("type") in LIST_WIDGETS else value
             for name, widget in forms.items()
             if ensure_list(value := parameters.get(name))
         }
+
+    def random_parameters_batch(
+        self, parameters: dict[str, Any], size: int, seed: int | None = None
+    ) -> list[dict[str, Any]]:
+        import numpy as np
+
+        rng = random.Random(seed)
+        np_rng = np.random.default_rng(seed)
+        # Widgets that do not depend on constraints are sampled in one go
+        selections = {
+            form["name"]: iter(
+                widget_random_selections(
+                    form["type"], size, np_rng, **form.get("details", {})
+                )
+            )
+            for form in self.form
+            if form.get("name") and form["type"] in VECTORISED_WIDGETS
+        }
+        return [
+            self.random_parameters(parameters, selections, rng) for _ in range(size)
+        ]
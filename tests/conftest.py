@@ -1,3 +1,7 @@
+import http.server
+import threading
+from typing import Iterator
+
 import pytest
 
 
@@ -9,3 +13,26 @@ def url() -> None:
 @pytest.fixture()
 def keys() -> list[str]:
     return []
+
+
+@pytest.fixture(scope="module")
+def server_handler() -> type[http.server.BaseHTTPRequestHandler]:
+    # Override in test modules to serve custom responses
+    return http.server.BaseHTTPRequestHandler
+
+
+@pytest.fixture(scope="module")
+def server_url(
+    server_handler: type[http.server.BaseHTTPRequestHandler],
+) -> Iterator[str]:
+    handler = type(
+        server_handler.__name__,
+        (server_handler,),
+        {"log_message": lambda self, *args: None},
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
@@ -60,8 +60,21 @@ def test_client_make_reports(
         time=time,
         content_length=0,
         content_type="application/x-grib",
+        time_to_first_byte=actual_report.time_to_first_byte,
+        transfer_time=actual_report.transfer_time,
+        throughput=actual_report.throughput,
+        latency=actual_report.latency,
+        job_created_at=actual_report.job_created_at,
+        job_started_at=actual_report.job_started_at,
+        job_finished_at=actual_report.job_finished_at,
+        queue_time=actual_report.queue_time,
+        status_history=actual_report.status_history,
     )
     assert actual_report == expected_report
+    if download:
+        assert actual_report.transfer_time is not None
+    else:
+        assert actual_report.transfer_time is None
 
 
 @pytest.mark.parametrize(
@@ -282,6 +295,7 @@ def test_max_runtime(
         )
     )
     assert not report.tracebacks
+    assert not report.cancelled
 
     if use_settings:
         dummy_request.settings = Settings(max_runtime=0)
@@ -295,6 +309,7 @@ def test_max_runtime(
     )
     (traceback,) = report.tracebacks
     assert traceback.endswith("TimeoutError: Maximum runtime exceeded.\n")
+    assert report.cancelled
 
 
 def test_client_requests_pool(
@@ -325,3 +340,41 @@ def test_get_elapsed_time(
         )
     )
     assert report.time if get_elapsed_time else report.time is None
+
+
+@pytest.mark.parametrize("checks", [Checks(), Checks(size=0)])
+def test_download_sample_size(
+    url: str, keys: list[str], dummy_request: Request, checks: Checks
+) -> None:
+    request = Request(checks=checks, **dummy_request.model_dump(exclude={"checks"}))
+    (report,) = list(
+        reports_generator(
+            url=url,
+            keys=keys,
+            requests=[request],
+            download_sample_size=1024,
+        )
+    )
+    assert not report.tracebacks
+    assert report.extension == ".grib"
+    if checks.size is None:
+        assert report.size is None and report.checksum is None
+    else:
+        assert report.size == 0
+
+
+def test_measure_cache(url: str, keys: list[str], dummy_request: Request) -> None:
+    cold_report, warm_report = list(
+        reports_generator(
+            url=url,
+            keys=keys,
+            requests=[dummy_request],
+            cache_key="_no_cache",
+            measure_cache=True,
+        )
+    )
+    assert not cold_report.tracebacks and not warm_report.tracebacks
+    assert (cold_report.cache, warm_report.cache) == ("cold", "warm")
+    assert warm_report.paired_request_uid == cold_report.request_uid
+    assert warm_report.request.parameters == cold_report.request.parameters
+    assert cold_report.latency and warm_report.latency
@@ -52,7 +52,7 @@ def test_cli_make_report_from_yaml(
     )
 
     captured = capsys.readouterr()
-    assert captured.out == "NUMBER OF REPORTS: 1\nPASSED: 1 (100.0%)\n"
+    assert captured.out.startswith("NUMBER OF REPORTS: 1\nPASSED: 1 (100.0%)\n")
 
     (actual_report,) = models.load_reports(report_path.open())
     expected_report = Report(
@@ -78,6 +78,15 @@ def test_cli_make_report_from_yaml(
         time=actual_report.time,
         content_length=0,
         content_type="application/x-grib",
+        time_to_first_byte=actual_report.time_to_first_byte,
+        transfer_time=actual_report.transfer_time,
+        throughput=actual_report.throughput,
+        latency=actual_report.latency,
+        job_created_at=actual_report.job_created_at,
+        job_started_at=actual_report.job_started_at,
+        job_finished_at=actual_report.job_finished_at,
+        queue_time=actual_report.queue_time,
+        status_history=actual_report.status_history,
     )
 
     assert actual_report == expected_report
@@ -1,5 +1,6 @@
 from pathlib import Path
 
+import pydantic
 import pytest
 
 from cads_e2e_tests import models
@@ -18,11 +19,13 @@ def report() -> Report:
                 time=0.1,
                 content_length=10,
                 content_type="foo-type",
+                format="grib",
             ),
             settings=Settings(max_runtime=60),
         ),
         checksum="bar",
         extension=".bar",
+        format="netcdf",
         size=1,
         time=1,
         content_length=20,
@@ -36,6 +39,7 @@ def test_report_run_checks(report: Report) -> None:
         "cads_e2e_tests.exceptions.ContentLengthError: actual=20 expected=10",
         "cads_e2e_tests.exceptions.ContentTypeError: actual='bar-type' expected='foo-type'",
         "cads_e2e_tests.exceptions.ExtensionError: actual='.bar' expected='.foo'",
+        "cads_e2e_tests.exceptions.FormatError: actual='netcdf' expected='grib'",
         "cads_e2e_tests.exceptions.SizeError: actual=1 expected=0",
         "cads_e2e_tests.exceptions.TimeError: actual=1.0 expected=0.1",
     ]
@@ -62,3 +66,64 @@ def test_dump_and_load_requests(report: Report, tmp_path: Path) -> None:
     models.dump_requests(expected_requests, requests_path.open("w"))
     actual_requests = models.load_requests(requests_path.open("r"))
     assert actual_requests == expected_requests
+
+
+def test_iter_requests(report: Report, tmp_path: Path) -> None:
+    requests_path = tmp_path / "requests.jsonl"
+    with requests_path.open("w") as fp:
+        for _ in range(2):
+            models.dump_request(report.request, fp)
+        fp.write("\n")
+    actual_requests = models.iter_requests(requests_path.open("r"))
+    assert next(actual_requests) == report.request
+    assert list(actual_requests) == [report.request]
+
+
+def test_iter_trace_requests(tmp_path: Path) -> None:
+    trace_path = tmp_path / "trace.jsonl"
+    trace_path.write_text(
+        '{"timestamp": "2000-01-01T00:00:00", "collection_id": "foo"}\n'
+        '{"timestamp": "2000-01-01T00:00:10", "collection_id": "bar",'
+        ' "parameters": {"year": "2000"}}\n'
+    )
+    foo, bar = models.iter_trace_requests(trace_path.open(), speed=10)
+    assert foo.settings.submit_at == 0
+    assert bar.settings.submit_at == 1
+    assert bar.parameters == {"year": "2000"}
+    assert bar.settings.randomise is False
+
+
+def test_settings_weight() -> None:
+    assert Settings(weight=0).weight == 0
+    with pytest.raises(pydantic.ValidationError):
+        Settings(weight=-1)
+
+
+def test_run_aggregate_checks() -> None:
+    checks = Checks(p95_time=10, median_throughput=2, failure_rate=25)
+    reports = [
+        Report(request=Request(collection_id="foo", checks=checks), time=time)
+        for time in (1, 2, 20)
+    ]
+    reports.append(
+        Report(
+            request=Request(collection_id="foo", checks=checks),
+            throughput=1e6,
+            tracebacks=["foo"],
+        )
+    )
+    reports.append(Report(request=Request(collection_id="bar"), time=100))
+
+    tracebacks = models.run_aggregate_checks(reports)
+    assert list(tracebacks) == ["foo"]
+    # The failure rate is not above the threshold
+    p95_traceback, throughput_traceback = tracebacks["foo"]
+    assert p95_traceback.endswith("PercentileTimeError: actual=18.2 expected=10.0\n")
+    assert throughput_traceback.endswith("ThroughputError: actual=1.0 expected=2.0\n")
+
+    # Thresholds can be overridden for all collections
+    tracebacks = models.run_aggregate_checks(reports, Checks(failure_rate=20))
+    assert list(tracebacks) == ["foo"]
+    assert tracebacks["foo"][0].endswith(
+        "FailureRateError: actual=25.0 expected=20.0\n"
+    )
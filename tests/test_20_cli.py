@@ -1,9 +1,11 @@
 from typing import Any
 
 import pytest
+import typer
+from typer.testing import CliRunner
 
 from cads_e2e_tests import cli
-from cads_e2e_tests.models import Report, Request
+from cads_e2e_tests.models import Checks, Report, Request
 
 
 def test_echo_passed_vs_failed(capsys: pytest.CaptureFixture[Any]) -> None:
@@ -18,3 +20,94 @@ def test_echo_passed_vs_failed(capsys: pytest.CaptureFixture[Any]) -> None:
     assert (
         captured.out == "NUMBER OF REPORTS: 3\nFAILED: 1 (33.3%)\nPASSED: 2 (66.7%)\n"
     )
+
+
+def test_echo_download_stats(capsys: pytest.CaptureFixture[Any]) -> None:
+    request = Request(collection_id="foo")
+    reports: list[Report] = [
+        Report(
+            request=request,
+            time_to_first_byte=0.1,
+            transfer_time=2,
+            throughput=1e6,
+        ),
+        Report(
+            request=request,
+            time_to_first_byte=0.3,
+            transfer_time=4,
+            throughput=3e6,
+        ),
+        Report(request=Request(collection_id="bar")),
+    ]
+    cli.echo_download_stats(reports)
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [
+        "DOWNLOADS (median throughput, time to first byte, transfer time):",
+        "  foo: 2.00 MB/s, 0.200 s, 3.000 s (2 downloads)",
+    ]
+
+
+def test_default_command() -> None:
+    runner = CliRunner()
+    result = runner.invoke(cli.app, ["--help"])
+    assert result.exit_code == 0
+    assert "make-reports" in result.output and "generate" in result.output
+
+    result = runner.invoke(cli.app, ["--n-jobs", "foo"])
+    assert result.exit_code == 2
+    assert "make-reports" in result.output
+
+
+def test_echo_cache_stats(capsys: pytest.CaptureFixture[Any]) -> None:
+    request = Request(collection_id="foo")
+    reports: list[Report] = [
+        Report(request=request, cache="cold", latency=10),
+        Report(request=request, cache="warm", latency=1),
+        Report(request=request, cache="cold", latency=20),
+        Report(request=request, cache="warm", latency=3),
+        Report(request=Request(collection_id="bar"), latency=1),
+    ]
+    cli.echo_cache_stats(reports)
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [
+        "CACHE (median latency, cold vs warm):",
+        "  foo: 15.000 s vs 2.000 s (2 pairs)",
+    ]
+
+
+def test_echo_queue_stats(capsys: pytest.CaptureFixture[Any]) -> None:
+    reports: list[Report] = [
+        Report(request=Request(collection_id="foo"), queue_time=queue_time)
+        for queue_time in range(101)
+    ]
+    reports.append(Report(request=Request(collection_id="bar")))
+    cli.echo_queue_stats(reports)
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [
+        "QUEUE TIME (p50, p90, p99):",
+        "  foo: 50.0 s, 90.0 s, 99.0 s (101 jobs)",
+    ]
+
+
+def test_parse_max_in_flight_groups() -> None:
+    assert cli.parse_max_in_flight_groups(["^era5=2", "a=b=3"]) == {
+        "^era5": 2,
+        "a=b": 3,
+    }
+    with pytest.raises(typer.BadParameter):
+        cli.parse_max_in_flight_groups(["^era5"])
+
+
+def test_echo_aggregate_checks(capsys: pytest.CaptureFixture[Any]) -> None:
+    reports = [
+        Report(request=Request(collection_id="foo"), tracebacks=["foo"]),
+        Report(request=Request(collection_id="foo")),
+    ]
+    assert cli.echo_aggregate_checks(reports)
+    assert capsys.readouterr().out == ""
+
+    assert not cli.echo_aggregate_checks(reports, Checks(failure_rate=10))
+    assert capsys.readouterr().out.splitlines() == [
+        "AGGREGATE CHECKS FAILED:",
+        "  foo: cads_e2e_tests.exceptions.FailureRateError: actual=50.0 expected=10.0",
+    ]
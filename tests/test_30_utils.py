@@ -1,9 +1,13 @@
+import collections
 import contextlib
+import itertools
 import logging
 import os
+import random
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import pytest
 
 from cads_e2e_tests import utils
@@ -11,10 +15,14 @@ from cads_e2e_tests import utils
 does_not_raise = contextlib.nullcontext
 
 
-def test_utils_tmp_working_dir(tmp_path: Path) -> None:
-    with utils.tmp_working_dir(str(tmp_path)) as tmpdir:
-        assert os.getcwd() == os.path.realpath(tmpdir)
-        assert os.path.dirname(tmpdir) == str(tmp_path.resolve())
+def test_utils_tmp_working_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "foo").mkdir()
+    with utils.tmp_working_dir("foo") as tmpdir:
+        assert os.getcwd() == str(tmp_path)
+        assert os.path.isabs(tmpdir)
+        assert os.path.isdir(tmpdir)
+        assert os.path.dirname(tmpdir) == str(tmp_path / "foo")
     assert not os.path.exists(tmpdir)
 
 
@@ -69,6 +77,13 @@ def test_reorder(cyclic: bool, randomise: bool, expected: set[list[int]]) -> Non
         assert actual in expected
 
 
+def test_iter_reorder() -> None:
+    requests = iter(range(3))
+    reordered = utils.iter_reorder(requests, cyclic=False, randomise=False, n_repeats=2)
+    assert list(itertools.islice(reordered, 3)) == [0, 0, 1]
+    assert next(requests) == 2
+
+
 def test_random_choiche_from_range() -> None:
     for _ in range(100):
         assert utils.random_choice_from_range(0, 0.2, 0.1) in [0, 0.1, 0.2]
@@ -94,3 +109,106 @@ def test_random_range_from_range() -> None:
 )
 def test_ensure_list(value: Any, expected: list[Any]) -> None:
     assert utils.ensure_list(value) == expected
+
+
+def test_random_dates() -> None:
+    dates = utils.random_dates("2000-01-01", "2000-01-03", 100)
+    assert len(dates) == 100
+    assert set(dates) <= {"2000-01-01", "2000-01-02", "2000-01-03"}
+
+
+def test_random_choices_from_range() -> None:
+    choices = utils.random_choices_from_range(0, 0.2, 0.1, size=100)
+    assert len(choices) == 100
+    assert set(choices.round(1)) <= {0, 0.1, 0.2}
+
+
+def test_random_ranges_from_range() -> None:
+    starts, stops = utils.random_ranges_from_range(-10, 10, 1, 2, 4, size=100)
+    assert ((-10 <= starts) & (starts <= stops) & (stops <= 10)).all()
+    assert ((2 <= stops - starts) & (stops - starts <= 4)).all()
+
+
+@pytest.mark.parametrize(
+    "widget_type,details",
+    [
+        ("DateRangeWidget", {"minStart": "2000-01-01", "maxEnd": "2000-12-31"}),
+        ("GeographicExtentWidget", {"precision": 1}),
+        ("GeographicLocationWidget", {}),
+        ("StringListWidget", {"values": ["foo", "bar"]}),
+    ],
+)
+def test_widget_random_selections(
+    widget_type: utils.WidgetType, details: dict[str, Any]
+) -> None:
+    rng = np.random.default_rng(0)
+    selections = utils.widget_random_selections(widget_type, 10, rng=rng, **details)
+    assert len(selections) == 10
+    for selection in selections:
+        assert type(selection) is type(
+            utils.widget_random_selection(widget_type, **details)
+        )
+
+    # Selections are reproducible, including the scalar fallback
+    assert selections == utils.widget_random_selections(
+        widget_type, 10, rng=np.random.default_rng(0), **details
+    )
+
+
+class DummyCollectionUtils(utils.AbstractCollectionUtils):
+    form = [
+        {"name": "variable", "type": "StringListWidget", "required": True},
+        {
+            "name": "date",
+            "type": "DateRangeWidget",
+            "required": True,
+            "details": {"minStart": "2000-01-01", "maxEnd": "2000-01-03"},
+        },
+    ]
+
+    def apply_constraints(self, parameters: dict[str, Any]) -> dict[str, Any]:
+        return {"variable": ["foo", "bar"]}
+
+
+def test_random_parameters_batch() -> None:
+    batch = DummyCollectionUtils().random_parameters_batch({}, 10)
+    assert len(batch) == 10
+    for parameters in batch:
+        assert set(parameters) == {"variable", "date"}
+        assert parameters["variable"] in (["foo"], ["bar"])
+        (date,) = parameters["date"]
+        assert date in {f"2000-01-0{day}/2000-01-0{day}" for day in (1, 2, 3)}
+
+
+def test_random_parameters_seed() -> None:
+    collection_utils = DummyCollectionUtils()
+    batch = collection_utils.random_parameters_batch({}, 10, seed=0)
+    assert collection_utils.random_parameters_batch({}, 10, seed=0) == batch
+
+    parameters = collection_utils.random_parameters({}, rng=random.Random(0))
+    assert collection_utils.random_parameters({}, rng=random.Random(0)) == parameters
+
+
+def test_derive_seed() -> None:
+    assert utils.derive_seed(0, "foo", 1) == utils.derive_seed(0, "foo", 1)
+    assert utils.derive_seed(0, "foo", 1) != utils.derive_seed(0, "foo", 2)
+
+
+def test_alias_sampler() -> None:
+    sampler = utils.AliasSampler([3, 0, 1])
+    rng = random.Random(0)
+    counts = collections.Counter(sampler.sample(rng) for _ in range(10_000))
+    assert counts[1] == 0
+    assert counts[0] / counts[2] == pytest.approx(3, rel=0.1)
+
+    with pytest.raises(ValueError):
+        utils.AliasSampler([0, 0])
+
+
+def test_iter_weighted_sample() -> None:
+    sample = utils.iter_weighted_sample(["foo", "bar"], [1, 0], 3)
+    assert list(sample) == ["foo"] * 3
+
+    assert list(utils.iter_weighted_sample([], [], 3)) == []
+    assert list(utils.iter_weighted_sample(["foo"], [0], 3)) == []
+    assert list(utils.iter_weighted_sample(["foo"], [1], 0)) == []
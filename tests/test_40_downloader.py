@@ -0,0 +1,163 @@
+import hashlib
+import http.server
+from pathlib import Path
+
+import pytest
+import requests
+from ecmwf.datastores.processing import DownloadError
+
+from cads_e2e_tests import downloader
+
+CONTENT = b"GRIB" + bytes(range(256)) * 1024
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    interrupted: set[str] = set()
+
+    def do_GET(self) -> None:
+        content = CONTENT
+        range_header = self.headers.get("Range")
+        if range_header and not self.path.startswith("/no-ranges/"):
+            start, stop = range_header.removeprefix("bytes=").split("-")
+            stop = stop or str(len(CONTENT) - 1)
+            content = CONTENT[int(start) : int(stop) + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{stop}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if "/interrupted/" in self.path and self.path not in self.interrupted:
+            # Drop the connection halfway through the first response
+            self.interrupted.add(self.path)
+            self.wfile.write(content[: len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content)
+
+
+@pytest.fixture(scope="module")
+def server_handler() -> type[http.server.BaseHTTPRequestHandler]:
+    return Handler
+
+
+def test_downloader_target_from_url() -> None:
+    assert downloader.target_from_url("http://foo/bar/baz.nc?qux=1") == "baz.nc"
+
+
+def test_downloader_download(server_url: str, tmp_path: Path) -> None:
+    target = str(tmp_path / "data.grib")
+    info = downloader.download(
+        requests.Session(),
+        f"{server_url}/path/to/data.grib",
+        target=target,
+        content_length=len(CONTENT),
+        chunk_size=1024,
+    )
+
+    assert info.target == target
+    assert info.extension == ".grib"
+    assert info.format == "grib"
+    assert info.size == len(CONTENT)
+    assert info.checksum == hashlib.md5(CONTENT).hexdigest()
+    assert Path(target).read_bytes() == CONTENT
+    assert 0 <= info.time_to_first_byte <= info.transfer_time
+    assert info.throughput == info.size / info.transfer_time
+
+
+def test_downloader_download_size_mismatch(server_url: str, tmp_path: Path) -> None:
+    with pytest.raises(DownloadError, match="downloaded 262148 byte"):
+        downloader.download(
+            requests.Session(),
+            f"{server_url}/data.grib",
+            target=str(tmp_path / "data.grib"),
+            content_length=1,
+        )
+
+
+@pytest.mark.parametrize("path", ["ranges", "no-ranges"])
+@pytest.mark.parametrize("connections", [1, 3])
+def test_downloader_download_parts(
+    server_url: str, tmp_path: Path, path: str, connections: int
+) -> None:
+    target = str(tmp_path / "data.grib")
+    info = downloader.download(
+        requests.Session(),
+        f"{server_url}/{path}/data.grib",
+        target=target,
+        content_length=len(CONTENT),
+        connections=connections,
+        part_size=10_000,
+    )
+
+    assert info.size == len(CONTENT)
+    assert info.checksum == hashlib.md5(CONTENT).hexdigest()
+    assert Path(target).read_bytes() == CONTENT
+
+
+@pytest.mark.parametrize(
+    "path,connections", [("ranges", 1), ("no-ranges", 1), ("ranges", 3)]
+)
+def test_downloader_download_retries(
+    server_url: str, tmp_path: Path, path: str, connections: int
+) -> None:
+    url = f"{server_url}/{path}/interrupted/{connections}/data.grib"
+    info = downloader.download(
+        requests.Session(),
+        url,
+        target=str(tmp_path / "data.grib"),
+        content_length=len(CONTENT),
+        connections=connections,
+        part_size=100_000,
+        maximum_tries=2,
+    )
+
+    assert info.size == len(CONTENT)
+    assert info.checksum == hashlib.md5(CONTENT).hexdigest()
+    assert info.n_retries == 1
+
+
+def test_downloader_download_maximum_tries(server_url: str, tmp_path: Path) -> None:
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        downloader.download(
+            requests.Session(),
+            f"{server_url}/interrupted/data.grib",
+            target=str(tmp_path / "data.grib"),
+            content_length=len(CONTENT),
+        )
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [
+        (b"GRIB\x00", "grib"),
+        (b"CDF\x01\x00", "netcdf"),
+        (b"CDF\x02\x00", "netcdf"),
+        (b"\x89HDF\r\n\x1a\n\x00", "hdf5"),
+        (b"PK\x03\x04\x00", "zip"),
+        (b"foo", None),
+        (b"", None),
+    ],
+)
+def test_downloader_sniff_format(content: bytes, expected: str | None) -> None:
+    assert downloader.sniff_format(content) == expected
+
+
+@pytest.mark.parametrize("path", ["ranges", "no-ranges"])
+def test_downloader_sample(server_url: str, path: str) -> None:
+    info = downloader.sample(
+        requests.Session(),
+        f"{server_url}/{path}/data.grib",
+        content_length=len(CONTENT),
+        sample_size=100,
+    )
+    assert info.target == "data.grib"
+    assert info.extension == ".grib"
+    assert info.format == "grib"
+    assert info.content == CONTENT[:100]
+    assert info.content_length == len(CONTENT)
+
+    with pytest.raises(DownloadError, match="headers report 262148 byte"):
+        downloader.sample(
+            requests.Session(), f"{server_url}/{path}/data.grib", content_length=1
+        )
@@ -0,0 +1,476 @@
+import collections
+import http.server
+import json
+import os
+import threading
+import time
+from typing import Any
+
+import pytest
+
+from cads_e2e_tests import scheduler
+from cads_e2e_tests.client import get_test_client
+from cads_e2e_tests.models import Report, Request, Settings
+
+
+class DummyClient:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.n_downloading = 0
+        self.max_downloading = 0
+        self.n_submitted = 0
+
+    def make_partial_report(
+        self, request: Request, **kwargs: Any
+    ) -> tuple[Report, str | None]:
+        with self.lock:
+            self.n_submitted += 1
+            request_uid = str(self.n_submitted)
+        if request.collection_id == "fail":
+            report = Report(
+                request=request, request_uid=request_uid, tracebacks=["foo"]
+            )
+            return report, None
+        report = Report(request=request, request_uid=request_uid)
+        return report, f"http://foo/{request.collection_id}.grib"
+
+    def download_report(self, report: Report, location: str, target: str) -> Report:
+        with self.lock:
+            self.n_downloading += 1
+            self.max_downloading = max(self.max_downloading, self.n_downloading)
+        with open(target, "w") as f:
+            f.write(location)
+        with self.lock:
+            self.n_downloading -= 1
+        return Report(
+            extension=os.path.splitext(target)[1],
+            size=len(location),
+            **report.model_dump(exclude={"extension", "size"}),
+        )
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+@pytest.mark.parametrize("n_download_jobs", [None, 1, 2])
+@pytest.mark.parametrize("download", [True, False])
+def test_scheduler_run(
+    monkeypatch: pytest.MonkeyPatch,
+    n_jobs: int,
+    n_download_jobs: int | None,
+    download: bool,
+) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    requests = [Request(collection_id=f"foo-{i}") for i in range(5)]
+    requests.append(Request(collection_id="fail"))
+    tasks = [({"key": "foo"}, request) for request in requests]
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=n_jobs,
+        backend="threading",
+        n_download_jobs=n_download_jobs,
+        clients_kwargs=[{"key": "foo"}],
+    )
+
+    reports = list(test_scheduler.run(tasks, download=download))
+
+    assert sorted(report.request.collection_id for report in reports) == sorted(
+        request.collection_id for request in requests
+    )
+    for report in reports:
+        if report.request.collection_id == "fail":
+            assert report.tracebacks == ["foo"]
+            assert report.size is None
+        elif download:
+            assert report.extension == ".grib"
+            assert report.size == len(f"http://foo/{report.request.collection_id}.grib")
+        else:
+            assert report.size is None
+    if n_download_jobs is not None:
+        assert client.max_downloading <= n_download_jobs
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_scheduler_run_measure_cache(
+    monkeypatch: pytest.MonkeyPatch, n_jobs: int
+) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    requests = [
+        Request(collection_id="foo", parameters={"_no_cache": "bar"}),
+        Request(collection_id="fail"),
+    ]
+    tasks = [({"key": "foo"}, request) for request in requests]
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=n_jobs, backend="threading", clients_kwargs=[{"key": "foo"}]
+    )
+
+    reports = list(
+        test_scheduler.run(
+            tasks, download=False, measure_cache=True, cache_key="_no_cache"
+        )
+    )
+
+    # Failed cold requests are not replayed
+    cold_reports = {
+        report.request.collection_id: report
+        for report in reports
+        if report.cache == "cold"
+    }
+    (warm_report,) = [report for report in reports if report.cache == "warm"]
+    assert set(cold_reports) == {"foo", "fail"}
+    assert warm_report.paired_request_uid == cold_reports["foo"].request_uid
+    assert warm_report.request.parameters == {"_no_cache": "bar"}
+    assert warm_report.request.settings.randomise is False
+
+
+def test_scheduler_run_close(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    monkeypatch.setattr(scheduler, "cancel_live_requests", lambda: 2)
+    tasks = [({"key": "foo"}, Request(collection_id=f"foo-{i}")) for i in range(5)]
+    test_scheduler = scheduler.Scheduler(clients_kwargs=[{"key": "foo"}])
+
+    reports = test_scheduler.run(tasks, download=False)
+    next(reports)
+    assert test_scheduler.n_cancelled == 0
+    reports.close()  # type: ignore[attr-defined]
+    assert test_scheduler.n_cancelled == 2
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    deleted: list[list[str]] = []
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path.endswith("/jobs/delete"):
+            self.deleted.append(json.loads(body)["job_ids"])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+@pytest.fixture(scope="module")
+def server_handler() -> type[http.server.BaseHTTPRequestHandler]:
+    return Handler
+
+
+def test_scheduler_cancel_worker_requests(server_url: str) -> None:
+    client_kwargs = {"url": f"{server_url}/api", "key": "foo", "maximum_tries": 1}
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=2, backend="loky", clients_kwargs=[client_kwargs]
+    )
+    executor = test_scheduler.get_executor()
+
+    # Jobs submitted in a worker process are deleted by the parent process
+    executor.submit(
+        lambda: get_test_client(**client_kwargs)._track_request("foo-uid", live=True)
+    ).result()
+    test_scheduler.cancel_live_requests()
+    assert test_scheduler.n_cancelled == 1
+    assert Handler.deleted == [["foo-uid"]]
+
+    test_scheduler.cancel_live_requests()
+    assert test_scheduler.n_cancelled == 1
+
+
+def test_scheduler_run_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    tasks = [({"key": "foo"}, Request(collection_id=f"foo-{i}")) for i in range(5)]
+    test_scheduler = scheduler.Scheduler(
+        run_deadline=time.time() - 1, clients_kwargs=[{"key": "foo"}]
+    )
+    reports = list(test_scheduler.run(tasks, download=False))
+    assert client.n_submitted == 0
+    # Dropped tasks are reported
+    assert [report.request for report in reports] == [request for _, request in tasks]
+    for report in reports:
+        assert report.timeout == "deadline"
+        assert "DeadlineTimeoutError" in report.tracebacks[0]
+
+
+def test_scheduler_run_submit_at(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    tasks = [
+        (
+            {"key": "foo"},
+            Request(collection_id=f"foo-{i}", settings=Settings(submit_at=i / 10)),
+        )
+        for i in range(3)
+    ]
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=2, backend="threading", clients_kwargs=[{"key": "foo"}]
+    )
+
+    tic = time.perf_counter()
+    reports = list(test_scheduler.run(tasks, download=False))
+    assert time.perf_counter() - tic >= 0.2
+
+    for report in reports:
+        assert report.submit_offset is not None
+        assert report.request.settings.submit_at is not None
+        assert report.submit_offset >= report.request.settings.submit_at
+
+
+def test_in_flight_limiter() -> None:
+    limiter = scheduler.InFlightLimiter(max_in_flight=1, groups={"^slow-": 2})
+    assert limiter.get_group("slow-foo") == limiter.get_group("slow-bar")
+    assert limiter.get_group("foo") == ("foo", 1)
+
+    for collection_id in ("slow-foo", "slow-bar", "foo"):
+        assert not limiter.is_full(collection_id)
+        limiter.acquire(collection_id)
+    assert limiter.is_full("slow-baz")
+    assert limiter.is_full("foo")
+    assert not limiter.is_full("bar")
+
+    slow_task = ({"key": "foo"}, Request(collection_id="slow-baz"))
+    foo_task = ({"key": "foo"}, Request(collection_id="foo"))
+    limiter.defer(slow_task)
+    limiter.defer(foo_task)
+    assert limiter.pop_ready() is None
+
+    limiter.release("foo")
+    assert limiter.pop_ready() == foo_task
+    limiter.release("slow-foo")
+    assert limiter.pop_ready() == slow_task
+    assert limiter.n_deferred == 0
+
+
+def test_task_selector() -> None:
+    client_kwargs = {"key": "foo"}
+    new_task = (client_kwargs, Request(collection_id="new"))
+    later_task = (
+        client_kwargs,
+        Request(collection_id="later", settings=Settings(submit_at=60)),
+    )
+    limiter = scheduler.InFlightLimiter(max_in_flight=1)
+    selector = scheduler.TaskSelector(
+        iter([new_task, new_task, later_task]), limiter, max_deferred=10
+    )
+
+    # Replays, then deferred tasks, then repeats, then new tasks
+    limiter.acquire("new")
+    cold_report = Report(request=Request(collection_id="cold"))
+    selector.replays.append((client_kwargs, cold_report))
+    selector.repeats.append((client_kwargs, Request(collection_id="repeat")))
+    replay = selector.select()
+    assert replay is not None
+    assert replay.cold_report == cold_report
+    assert replay.request.settings.randomise is False
+    repeat = selector.select()
+    assert repeat is not None and repeat.request.collection_id == "repeat"
+    # The new tasks are deferred while their collection is full
+    assert selector.select() is None
+    due_in = selector.due_in()
+    assert due_in is not None and due_in > 50
+    assert limiter.n_deferred == 2
+    limiter.release("new")
+    deferred = selector.select()
+    assert deferred is not None and deferred.request.collection_id == "new"
+
+    dropped = [submission.request.collection_id for submission in selector.drop()]
+    assert dropped == ["later", "new"]
+    assert not selector.has_tasks()
+    assert selector.due_in() is None
+
+
+def test_task_selector_full_replays() -> None:
+    client_kwargs = {"key": "foo"}
+    limiter = scheduler.InFlightLimiter(max_in_flight=1)
+    selector = scheduler.TaskSelector(iter([]), limiter, max_deferred=10)
+    for collection_id in ("foo", "bar"):
+        cold_report = Report(request=Request(collection_id=collection_id))
+        selector.replays.append((client_kwargs, cold_report))
+
+    # Replays of full collections are held back
+    limiter.acquire("foo")
+    replay = selector.select()
+    assert replay is not None and replay.request.collection_id == "bar"
+    limiter.acquire("bar")
+    assert selector.select() is None
+    assert selector.has_tasks()
+
+    limiter.release("foo")
+    replay = selector.select()
+    assert replay is not None and replay.request.collection_id == "foo"
+    assert not selector.has_tasks()
+
+
+def test_scheduler_run_max_in_flight(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    in_flight: dict[str, int] = {}
+    max_in_flight: dict[str, int] = {}
+    make_partial_report = client.make_partial_report
+
+    def slow_make_partial_report(
+        request: Request, **kwargs: Any
+    ) -> tuple[Report, str | None]:
+        collection_id = request.collection_id
+        with client.lock:
+            in_flight[collection_id] = in_flight.get(collection_id, 0) + 1
+            max_in_flight[collection_id] = max(
+                max_in_flight.get(collection_id, 0), in_flight[collection_id]
+            )
+        time.sleep(0.05 if collection_id == "slow" else 0.01)
+        with client.lock:
+            in_flight[collection_id] -= 1
+        return make_partial_report(request, **kwargs)
+
+    monkeypatch.setattr(client, "make_partial_report", slow_make_partial_report)
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    requests = [Request(collection_id="slow") for _ in range(6)]
+    requests += [Request(collection_id="fast") for _ in range(6)]
+    tasks = [({"key": "foo"}, request) for request in requests]
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=4,
+        backend="threading",
+        max_in_flight=2,
+        clients_kwargs=[{"key": "foo"}],
+    )
+
+    reports = list(test_scheduler.run(tasks, download=False))
+    assert len(reports) == 12
+    assert max_in_flight == {"slow": 2, "fast": 2}
+    # Fast requests overtake the slow ones
+    assert reports[-1].request.collection_id == "slow"
+
+
+def test_circuit_breaker() -> None:
+    breaker = scheduler.CircuitBreaker(max_consecutive_failures=2, probe_interval=0.1)
+    breaker.record("foo", failed=True)
+    breaker.record("foo", failed=False)
+    breaker.record("foo", failed=True)
+    assert breaker.allow("foo")
+    breaker.record("foo", failed=True)
+    assert not breaker.allow("foo")
+    assert breaker.allow("bar")
+
+    # Half-open: a single probe is let through
+    time.sleep(0.1)
+    assert breaker.allow("foo")
+    assert not breaker.allow("foo")
+    # Requests submitted before the breaker opened do not end the half-open state
+    breaker.record("foo", failed=True)
+    breaker.record("foo", failed=False)
+    assert breaker.is_open("foo")
+    assert not breaker.allow("foo")
+    breaker.record("foo", failed=True, probe=True)
+    assert not breaker.allow("foo")
+
+    time.sleep(0.1)
+    assert breaker.allow("foo")
+    breaker.record("foo", failed=False, probe=True)
+    assert breaker.allow("foo")
+    assert not breaker.is_open("foo")
+
+
+def test_circuit_breaker_failure_ratio() -> None:
+    breaker = scheduler.CircuitBreaker(max_failure_ratio=0.5, window=4)
+    for failed in (True, False, True):
+        breaker.record("foo", failed=failed)
+    assert breaker.allow("foo")
+    breaker.record("foo", failed=False)
+    assert not breaker.allow("foo")
+
+
+def test_scheduler_run_circuit_breaker(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    tasks = [({"key": "foo"}, Request(collection_id="fail")) for _ in range(5)]
+    tasks.append(({"key": "foo"}, Request(collection_id="foo")))
+    test_scheduler = scheduler.Scheduler(
+        circuit_breaker=scheduler.CircuitBreaker(max_consecutive_failures=2),
+        clients_kwargs=[{"key": "foo"}],
+    )
+
+    reports = list(test_scheduler.run(tasks, download=False))
+    assert [report.skipped for report in reports] == [False] * 2 + [True] * 3 + [False]
+    assert client.n_submitted == 3
+    assert test_scheduler.n_skipped == 3
+    assert (
+        reports[2].tracebacks[-1].endswith("CircuitOpenError: Circuit breaker open.\n")
+    )
+
+
+def test_adaptive_repeats() -> None:
+    adaptive_repeats = scheduler.AdaptiveRepeats(
+        max_relative_width=0.1, min_repeats=3, max_repeats=10
+    )
+    stable = Request(collection_id="stable")
+    noisy = Request(collection_id="noisy")
+    assert adaptive_repeats.record(stable, 1.0)
+    assert adaptive_repeats.record(stable, 1.0)
+    assert not adaptive_repeats.record(stable, 1.0)
+
+    resubmitted = [adaptive_repeats.record(noisy, latency) for latency in range(1, 11)]
+    assert resubmitted == [True] * 9 + [False]
+    assert adaptive_repeats.relative_width([]) == float("inf")
+
+    # Failures are retried, until min_repeats failures in a row
+    flaky = Request(collection_id="flaky")
+    resubmitted = [
+        adaptive_repeats.record(flaky, latency)
+        for latency in (None, None, 1.0, None, None, None)
+    ]
+    assert resubmitted == [True] * 5 + [False]
+
+
+def test_scheduler_run_adaptive_repeats(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    tasks = [({"key": "foo"}, Request(collection_id=f"foo-{i}")) for i in range(2)]
+    test_scheduler = scheduler.Scheduler(
+        n_jobs=2,
+        backend="threading",
+        adaptive_repeats=scheduler.AdaptiveRepeats(min_repeats=2, max_repeats=4),
+        clients_kwargs=[{"key": "foo"}],
+    )
+
+    reports = list(test_scheduler.run(tasks, download=False))
+    # Reports without latency are given up after min_repeats
+    assert sorted(report.request.collection_id for report in reports) == sorted(
+        ["foo-0", "foo-1"] * 2
+    )
+
+
+def test_scheduler_run_adaptive_repeats_randomised(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    client = DummyClient()
+    make_partial_report = client.make_partial_report
+
+    def randomised_partial_report(
+        request: Request, cache_key: str, **kwargs: Any
+    ) -> tuple[Report, str | None]:
+        parameters = dict(request.parameters)
+        if request.settings.randomise is not False:
+            parameters["draw"] = str(client.n_submitted)
+        parameters.setdefault(cache_key, str(time.perf_counter()))
+        request = Request(
+            parameters=parameters, **request.model_dump(exclude={"parameters"})
+        )
+        return make_partial_report(request, **kwargs)
+
+    monkeypatch.setattr(client, "make_partial_report", randomised_partial_report)
+    monkeypatch.setattr(scheduler, "get_test_client", lambda **kwargs: client)
+    tasks = [({"key": "foo"}, Request(collection_id="foo", settings=Settings()))] * 2
+    test_scheduler = scheduler.Scheduler(
+        adaptive_repeats=scheduler.AdaptiveRepeats(min_repeats=3, max_repeats=3),
+        clients_kwargs=[{"key": "foo"}],
+    )
+
+    reports = list(test_scheduler.run(tasks, download=False, cache_key="_key"))
+    # Each draw is repeated on its own, with a new cache key
+    draws = collections.Counter(report.request.parameters["draw"] for report in reports)
+    assert list(draws.values()) == [3, 3]
+    assert len({report.request.parameters["_key"] for report in reports}) == 6
@@ -0,0 +1,57 @@
+import datetime
+
+from cads_e2e_tests import reporter
+from cads_e2e_tests.models import Report, Request
+
+
+def make_report(request: Request, duration: float, failed: bool = False) -> Report:
+    started_at = datetime.datetime(2000, 1, 1)
+    return Report(
+        request=request,
+        started_at=started_at,
+        finished_at=started_at + datetime.timedelta(seconds=duration),
+        tracebacks=["foo"] if failed else [],
+    )
+
+
+def test_duration_predictor() -> None:
+    slow = Request(collection_id="foo", parameters={"year": "2000"})
+    fast = Request(collection_id="foo", parameters={"year": "2001"})
+    history = [
+        make_report(
+            Request(collection_id="foo", parameters={"year": "2000", "_key": "a"}), 10
+        ),
+        make_report(slow, 20),
+        make_report(slow, 100, failed=True),
+        make_report(fast, 1),
+        make_report(Request(collection_id="bar"), 5),
+    ]
+    predictor = reporter.DurationPredictor(history, cache_key="_key")
+
+    assert predictor.predict(slow) == 15
+    assert predictor.predict(fast) == 1
+    # Unknown requests fall back to their collection, then to the slowest one
+    assert predictor.predict(Request(collection_id="foo")) == 10
+    assert predictor.predict(Request(collection_id="baz")) == 10
+
+    requests = [fast, Request(collection_id="bar"), slow]
+    assert sorted(requests, key=predictor.predict, reverse=True) == [
+        slow,
+        Request(collection_id="bar"),
+        fast,
+    ]
+
+
+def test_clients_kwargs() -> None:
+    (loky,) = reporter._clients_kwargs(None, [], "loky", 4, 2, 8.0, pool_maxsize=None)
+    assert loky == {"url": None, "key": None, "max_request_rate": 8.0}
+
+    foo, bar = reporter._clients_kwargs(None, ["foo", "bar"], "threading", 16, 4, 8.0)
+    assert (foo["key"], bar["key"]) == ("foo", "bar")
+    assert foo["max_request_rate"] == 8.0
+    assert foo["pool_maxsize"] == 20
+
+    (client_kwargs,) = reporter._clients_kwargs(
+        None, [], "threading", 16, None, None, pool_maxsize=3
+    )
+    assert client_kwargs["pool_maxsize"] == 3
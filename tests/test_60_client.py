@@ -0,0 +1,254 @@
+import datetime
+import time
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from cads_e2e_tests import client, exceptions
+from cads_e2e_tests.models import Request
+
+CLIENT_KWARGS: dict[str, Any] = {
+    "url": "http://127.0.0.1:1/api",
+    "pool_maxsize": 3,
+    "maximum_tries": 1,
+}
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_client_get_test_client() -> None:
+    test_client = client.get_test_client(key="foo", **CLIENT_KWARGS)
+    assert client.get_test_client(key="foo", **CLIENT_KWARGS) is test_client
+    assert client.get_test_client(key="bar", **CLIENT_KWARGS) is not test_client
+
+    adapter = test_client.session.get_adapter(CLIENT_KWARGS["url"])
+    assert adapter._pool_maxsize == 3  # type: ignore[attr-defined]
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.parametrize(
+    "max_cost,expected_sizes,expected_error",
+    [
+        (None, [1, 2], None),
+        (2, [1, 2], None),
+        (1, [1], "CostError: actual=2 expected=1"),
+    ],
+)
+def test_client_update_request_parameters_within_budget(
+    monkeypatch: pytest.MonkeyPatch,
+    max_cost: float | None,
+    expected_sizes: list[int],
+    expected_error: str | None,
+) -> None:
+    # Random sizes alternate between 2 and 1, the cost is the size
+    sizes = iter([2, 1] * client.MAX_COST_RESAMPLES)
+    test_client = client.TestClient(key="foo", **CLIENT_KWARGS)
+    monkeypatch.setattr(
+        test_client,
+        "random_parameters",
+        lambda collection_id, parameters, rng: {"size": next(sizes)},
+    )
+    n_estimates = 0
+
+    def estimate_costs(collection_id: str, parameters: dict[str, Any]) -> Any:
+        nonlocal n_estimates
+        n_estimates += 1
+        return {"cost": parameters["size"], "limit": 2}
+
+    monkeypatch.setattr(test_client, "estimate_costs", estimate_costs)
+
+    request = Request(collection_id="foo")
+    actual, costs = test_client.update_request_parameters(
+        request, None, estimate_costs=True, max_cost=max_cost
+    )
+    assert costs == {"cost": 2 if max_cost != 1 else 1, "limit": 2}
+    assert actual.parameters["size"] in expected_sizes
+
+    report, location = test_client.make_partial_report(
+        Request(collection_id="foo", parameters={"size": 2}),
+        cache_key=None,
+        max_runtime=None,
+        max_replication_lag=0,
+        get_elapsed_time=False,
+        estimate_costs=True,
+        max_cost=max_cost,
+    )
+    assert report.cost == 2
+    # Estimates are cached per request fingerprint
+    assert n_estimates == len(test_client.costs)
+    # Requests within budget are submitted to the unreachable server
+    assert location is None
+    actual_error = report.tracebacks[-1].splitlines()[-1]
+    if expected_error is None:
+        assert "CostError" not in actual_error
+    else:
+        assert actual_error.endswith(expected_error)
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_client_cancel_requests(monkeypatch: pytest.MonkeyPatch) -> None:
+    test_client = client.TestClient(key="foo", **CLIENT_KWARGS)
+    deleted = []
+    monkeypatch.setattr(test_client, "delete", lambda *uids: deleted.append(uids))
+
+    test_client.live_request_uids.update({"foo", "bar", "baz"})
+    assert test_client.cancel_requests("foo", "qux") == 1
+    assert deleted == [("foo",)]
+
+    # Live jobs are deleted in one batch
+    assert test_client.cancel_live_requests() == 2
+    assert sorted(deleted[-1]) == ["bar", "baz"]
+    assert test_client.live_request_uids == set()
+    assert test_client.cancel_live_requests() == 0
+    assert len(deleted) == 2
+
+
+class DummyRemote:
+    def __init__(self, statuses: list[str], started: str | None) -> None:
+        self.statuses = iter(statuses)
+        self.started = started
+        self.last_status: str | None = None
+        self.log_start_time: str | None = None
+        self.logs: list[str] = []
+        self.n_polls = 0
+
+    @property
+    def json(self) -> dict[str, Any]:
+        self.n_polls += 1
+        log = [(f"2000-01-01T00:00:{self.n_polls:02d}", f"poll {self.n_polls}")]
+        return {
+            "status": next(self.statuses),
+            "started": self.started,
+            "metadata": {"log": log},
+        }
+
+    def _log_metadata(self, metadata: dict[str, Any]) -> None:
+        for self.log_start_time, message in metadata.get("log", []):
+            self.logs.append(message)
+
+    def info(self, *args: Any) -> None:
+        pass
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.parametrize(
+    "started,kwargs,expected_error",
+    [
+        (True, {"max_runtime": 0}, exceptions.RuntimeTimeoutError),
+        (False, {"max_runtime": 0}, exceptions.TotalTimeoutError),
+        (False, {"max_queue_time": 0}, exceptions.QueueTimeoutError),
+        (True, {"max_queue_time": 0}, exceptions.TotalTimeoutError),
+        (True, {"run_deadline": 0}, exceptions.DeadlineTimeoutError),
+    ],
+)
+def test_client_wait_on_results_with_timeout(
+    started: bool,
+    kwargs: dict[str, Any],
+    expected_error: type[exceptions.RequestTimeoutError],
+) -> None:
+    test_client = client.TestClient(key="foo", **CLIENT_KWARGS)
+    statuses = ["accepted"] + ["running" if started else "accepted"] * 100
+    remote = DummyRemote(statuses, "2000-01-01T00:00:00" if started else None)
+    kwargs = {"max_runtime": None, "total_deadline": time.time() + 0.1} | kwargs
+    status_history: list[tuple[float, str]] = []
+    with pytest.raises(expected_error) as excinfo:
+        test_client.wait_on_results_with_timeout(
+            remote,  # type: ignore[arg-type]
+            status_history=status_history,
+            **kwargs,
+        )
+    assert isinstance(excinfo.value, TimeoutError)
+    assert status_history[0] == (0, "accepted")
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_client_wait_on_results_status_history(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(client, "SLEEP_INCREMENTAL_RATIO", 0)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    test_client = client.TestClient(key="foo", **CLIENT_KWARGS)
+    statuses = ["accepted", "accepted", "running", "running", "successful"]
+    remote = DummyRemote(statuses, None)
+    status_history: list[tuple[float, str]] = []
+    job = test_client.wait_on_results_with_timeout(
+        remote,  # type: ignore[arg-type]
+        None,
+        status_history=status_history,
+    )
+    assert job["status"] == "successful"
+    # Server logs are relayed on each poll
+    assert remote.logs == [f"poll {i}" for i in range(1, 6)]
+    assert remote.log_start_time == "2000-01-01T00:00:05"
+    assert remote.last_status == "successful"
+    assert [status for _, status in status_history] == [
+        "accepted",
+        "running",
+        "successful",
+    ]
+
+
+def test_client_get_job_times() -> None:
+    job = {
+        "created": "2000-01-01T00:00:00",
+        "started": "2000-01-01T00:01:00",
+        "finished": "2000-01-01T00:01:30",
+    }
+    job_times = client.get_job_times(job)
+    assert job_times["queue_time"] == 60
+    assert job_times["job_finished_at"] == datetime.datetime(
+        2000, 1, 1, 0, 1, 30, tzinfo=datetime.timezone.utc
+    )
+    assert client.get_elapsed_time_from_json(job) == 30
+    assert client.get_job_times({})["queue_time"] is None
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_client_accept_all_missing_licences(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(client, "_LICENCES", {})
+    cache_path = str(tmp_path / "licences" / "accepted_licences.json")
+    calls: list[tuple[str, ...]] = []
+
+    def make_clients() -> list[client.TestClient]:
+        test_clients = []
+        for key in ("foo", "bar"):
+            test_client = client.TestClient(key=key, **CLIENT_KWARGS)
+
+            def get_licences(key: str = key) -> list[dict[str, Any]]:
+                calls.append(("get_licences", key))
+                return [{"id": "licence", "revision": 1}]
+
+            def check_authentication(key: str = key) -> dict[str, Any]:
+                calls.append(("check_authentication", key))
+                return {}
+
+            def accept_licence(licence_id: str, revision: int, key: str = key) -> Any:
+                calls.append(("accept_licence", key, licence_id))
+
+            monkeypatch.setattr(test_client, "get_licences", get_licences)
+            monkeypatch.setattr(
+                test_client, "check_authentication", check_authentication
+            )
+            monkeypatch.setattr(test_client, "get_accepted_licences", lambda: [])
+            monkeypatch.setattr(test_client, "accept_licence", accept_licence)
+            test_clients.append(test_client)
+        return test_clients
+
+    client.accept_all_missing_licences(make_clients(), cache_path=cache_path)
+    # The public licences are fetched once
+    assert [call[0] for call in calls].count("get_licences") == 1
+    assert sorted(call for call in calls if call[0] == "accept_licence") == [
+        ("accept_licence", "bar", "licence"),
+        ("accept_licence", "foo", "licence"),
+    ]
+
+    # Accepted licences are cached between runs
+    calls.clear()
+    client.accept_all_missing_licences(make_clients(), cache_path=cache_path)
+    assert calls == []
+
+    # Unwritable caches are ignored
+    (tmp_path / "file").touch()
+    cache_path = str(tmp_path / "file" / "accepted_licences.json")
+    client.accept_all_missing_licences(make_clients(), cache_path=cache_path)
+    assert [call[0] for call in calls].count("accept_licence") == 2
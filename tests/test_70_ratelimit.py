@@ -0,0 +1,100 @@
+import http.server
+import multiprocessing
+import threading
+import time
+
+import pytest
+import requests
+
+from cads_e2e_tests import ratelimit
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path == "/throttled":
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture(scope="module")
+def server_handler() -> type[http.server.BaseHTTPRequestHandler]:
+    return Handler
+
+
+def test_ratelimit_acquire() -> None:
+    rate_limiter = ratelimit.RateLimiter(rate=100, burst=2)
+    tic = time.perf_counter()
+    for _ in range(6):
+        rate_limiter.acquire()
+    assert time.perf_counter() - tic >= 0.04 - 0.01
+
+
+def test_ratelimit_throttle() -> None:
+    rate_limiter = ratelimit.RateLimiter(backoff=0.05)
+    tic = time.perf_counter()
+    rate_limiter.throttle()
+    rate_limiter.throttle()
+    assert rate_limiter.n_throttled == 2
+
+    # The backoff is shared by all threads
+    n_throttled = []
+    thread = threading.Thread(
+        target=lambda: n_throttled.append(rate_limiter.n_throttled)
+    )
+    thread.start()
+    thread.join()
+    assert n_throttled == [0]
+
+    rate_limiter.acquire()
+    assert time.perf_counter() - tic >= 0.1 - 0.01
+
+    rate_limiter.release()
+    assert rate_limiter.n_consecutive_throttles == 0
+
+
+def test_ratelimit_adapter(server_url: str) -> None:
+    rate_limiter = ratelimit.RateLimiter()
+    session = requests.Session()
+    session.mount(server_url, ratelimit.RateLimitedAdapter(rate_limiter))
+
+    assert session.get(f"{server_url}/throttled").status_code == 429
+    assert rate_limiter.n_throttled == 1
+    assert rate_limiter.n_consecutive_throttles == 1
+
+    assert session.get(f"{server_url}/ok").status_code == 200
+    assert rate_limiter.n_throttled == 1
+    assert rate_limiter.n_consecutive_throttles == 0
+
+
+def test_ratelimit_get_rate_limiter() -> None:
+    rate_limiter = ratelimit.get_rate_limiter(1)
+    assert ratelimit.get_rate_limiter(1) is rate_limiter
+    assert ratelimit.get_rate_limiter(2) is not rate_limiter
+
+
+def test_ratelimit_shared_state() -> None:
+    manager = multiprocessing.Manager()
+    try:
+        shared_state = (manager.dict(), manager.Lock())
+        ratelimit.share_rate_limiter_state(shared_state)
+        try:
+            rate_limiter = ratelimit.get_rate_limiter(1)
+        finally:
+            ratelimit.share_rate_limiter_state(None)
+        assert ratelimit.get_rate_limiter(1) is not rate_limiter
+
+        # Throttle events are seen by all rate limiters sharing the state
+        other_rate_limiter = ratelimit.RateLimiter(
+            backoff=0.1, state=shared_state[0], lock=shared_state[1]
+        )
+        other_rate_limiter.throttle()
+        assert rate_limiter.n_consecutive_throttles == 1
+        tic = time.perf_counter()
+        rate_limiter.acquire()
+        assert time.perf_counter() - tic >= 0.1 - 0.01
+    finally:
+        manager.shutdown()
@@ -0,0 +1,68 @@
+from typing import Any
+
+import pytest
+
+from cads_e2e_tests import resolver
+from cads_e2e_tests.models import Checks, Report, Request
+
+
+class DummyClient:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, ...]] = []
+
+    def get_jobs_by_id(self, *request_ids: str) -> dict[str, dict[str, Any]]:
+        self.calls.append(request_ids)
+        job = {
+            "created": "2000-01-01T00:00:00",
+            "started": "2000-01-01T00:00:01",
+            "finished": "2000-01-01T00:00:03",
+        }
+        jobs = {request_id: job for request_id in request_ids}
+        if "missing" in jobs:
+            jobs["missing"] = {"created": job["created"]}
+        if "invalid" in jobs:
+            jobs["invalid"] = job | {"created": "foo"}
+        return jobs
+
+
+def test_resolver_elapsed_time(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = DummyClient()
+    monkeypatch.setattr(resolver, "get_test_client", lambda **kwargs: client)
+    elapsed_time_resolver = resolver.ElapsedTimeResolver(
+        max_replication_lag=0.3, poll_interval=0.2
+    )
+    try:
+        futures = [
+            elapsed_time_resolver.submit(
+                {"key": "foo"},
+                Report(request=Request(collection_id="foo"), request_uid=request_uid),
+            )
+            for request_uid in ("foo", "missing", "invalid")
+        ]
+        futures.append(
+            elapsed_time_resolver.submit(
+                {"key": "foo"},
+                Report(
+                    request=Request(collection_id="foo", checks=Checks(time=1)),
+                    request_uid="bar",
+                ),
+            )
+        )
+        resolved, missing, invalid, failed = [
+            future.result(timeout=5) for future in futures
+        ]
+    finally:
+        elapsed_time_resolver.shutdown()
+
+    assert resolved.time == 2.0 and not resolved.tracebacks
+    assert resolved.queue_time == 1.0
+    assert missing.time is None
+    assert missing.tracebacks[-1].endswith(
+        "TimeoutError: Maximum replication lag exceeded.\n"
+    )
+    assert invalid.time is None
+    assert "foo" in invalid.tracebacks[-1]
+    assert failed.time == 2.0
+    assert failed.tracebacks[-1].endswith("TimeError: actual=2.0 expected=1.0\n")
+    # Pending reports are resolved in batches
+    assert ("foo", "missing", "invalid", "bar") in client.calls
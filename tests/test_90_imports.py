@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = {"ecmwf.datastores", "joblib", "numpy", "pydantic", "requests", "yaml"}
+
+
+@pytest.mark.parametrize("module", ["cads_e2e_tests", "cads_e2e_tests.cli"])
+def test_imports_are_lazy(module: str) -> None:
+    code = f"import sys, {module}; print(*sorted(set(sys.modules) & {HEAVY_MODULES}))"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    assert output.stdout.split() == []
+
+
+def test_lazy_attributes() -> None:
+    import cads_e2e_tests
+    from cads_e2e_tests import models, reporter
+
+    assert cads_e2e_tests.reports_generator is reporter.reports_generator
+    assert cads_e2e_tests.Report is models.Report
+    with pytest.raises(AttributeError):
+        cads_e2e_tests.foo